@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from SpecCorpus import write_filesystem_corpus
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+SITE_ID = "1"
+# every benchmark runs three passes - the first upload, a run where nothing changed and a run where every API changed
+PASSES = ("initial", "unchanged", "changed")
+
+
+def start_mock_server(args):
+    command = [sys.executable, os.path.join(BENCHMARKS_PATH, "MockServer.py"), "--port", str(args.port), "--latency", str(args.latency),
+               "--error-rate", str(args.error_rate), "--throttle-rate", str(args.throttle_rate)]
+    if args.retry_after is not None:
+        command += ["--retry-after", str(args.retry_after)]
+    mock_server = subprocess.Popen(command, cwd=BENCHMARKS_PATH)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", args.port), timeout=1).close()
+            return mock_server
+        except OSError:
+            time.sleep(0.1)
+    mock_server.kill()
+    raise Exception("The mock server did not start on port %d" % args.port)
+
+
+def create_config(args, work_path, source):
+    fetcher = {"type": None, "active": True, "settings": dict()}
+    if source == "filesystem":
+        fetcher["type"] = "FileSystemFetcher"
+        fetcher["settings"] = {"filesystem_path": os.path.join(work_path, "specs"), "index_path": os.path.join(work_path, "index")}
+    elif source == "3scale":
+        fetcher["type"] = "ThreeScaleFetcher"
+        fetcher["settings"] = {"three_scale_url": "bench.3scale.net", "three_scale_access_token": "bench", "cache_path": os.path.join(work_path, "cache")}
+    elif source == "azure":
+        fetcher["type"] = "AzureFetcher"
+        fetcher["settings"] = {"subscription_id": "bench", "resource_group_name": "bench", "service_name": "bench", "access_token": "bench", "cache_path": os.path.join(work_path, "cache")}
+    return {
+        "logging": {"status_path": work_path, "log_path": "", "level": "ERROR"},
+        "api_id": "bench",
+        "api_key": "bench",
+        "site_id": SITE_ID,
+        "management_url": "http://127.0.0.1:%d/api-security/api/" % args.port,
+        "default_action": "ALERT_ONLY",
+        "sync": {"state_path": os.path.join(work_path, "state"), "concurrency": args.concurrency},
+        "client": {"initial_rps": args.rps, "max_rps": args.rps},
+        "fetchers": [fetcher]
+    }
+
+
+def run_manager(args, config):
+    # the manager runs in its own process, so its CPU time and memory are measured without the mock server
+    env = dict(os.environ, BENCH_MOCK_URL="http://127.0.0.1:%d" % args.port)
+    start = time.monotonic()
+    manager = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_PATH, "ManagerRunner.py"), "-c", json.dumps(config)], env=env,
+                               stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    # the resource usage of the manager includes the processes which parse the files for it
+    pid, exit_status, usage = os.wait4(manager.pid, 0)
+    wall_time = time.monotonic() - start
+    manager.returncode = os.waitstatus_to_exitcode(exit_status) if hasattr(os, "waitstatus_to_exitcode") else exit_status >> 8
+    return wall_time, usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024.0, manager.returncode
+
+
+def run_benchmark(args, work_path, source, total_apis):
+    mock_url = "http://127.0.0.1:%d/_bench/" % args.port
+    requests.post(mock_url + "reset", json={"source_apis": total_apis, "revision": 0}).raise_for_status()
+    if source == "filesystem":
+        write_filesystem_corpus(os.path.join(work_path, "specs"), total_apis)
+    config = create_config(args, work_path, source)
+    results = []
+    for pass_name in PASSES:
+        if pass_name == "changed":
+            if source == "filesystem":
+                write_filesystem_corpus(os.path.join(work_path, "specs"), total_apis, revision=1)
+            requests.post(mock_url + "revision", json={"revision": 1}).raise_for_status()
+        stats_before = requests.get(mock_url + "stats").json()
+        wall_time, cpu_time, peak_rss, exit_code = run_manager(args, config)
+        stats_after = requests.get(mock_url + "stats").json()
+        imperva_requests = stats_after["requests"] - stats_before["requests"]
+        results.append({
+            "source": source,
+            "apis": total_apis,
+            "pass": pass_name,
+            "wall_time": round(wall_time, 3),
+            "imperva_requests": imperva_requests,
+            "requests_per_second": round(imperva_requests / wall_time, 1) if wall_time > 0 else 0,
+            "source_requests": stats_after["sources"] - stats_before["sources"],
+            "bytes_sent": stats_after["bytes_received"] - stats_before["bytes_received"],
+            "throttled": stats_after["throttled"] - stats_before["throttled"],
+            "cpu_time": round(cpu_time, 3),
+            "peak_rss_mb": round(peak_rss, 1),
+            "exit_code": exit_code
+        })
+        print_result(results[-1])
+    return results
+
+
+def print_header():
+    print("%-10s %7s %-9s %9s %9s %9s %9s %9s %7s" % ("source", "apis", "pass", "wall (s)", "requests", "req/s", "cpu (s)", "rss (MB)", "exit"))
+
+
+def print_result(result):
+    print("%-10s %7d %-9s %9.2f %9d %9.1f %9.2f %9.1f %7d" % (result["source"], result["apis"], result["pass"], result["wall_time"], result["imperva_requests"],
+                                                        result["requests_per_second"], result["cpu_time"], result["peak_rss_mb"], result["exit_code"]))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the sync of the API Security Manager against a local mock server")
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma separated numbers of APIs")
+    parser.add_argument("--sources", default="filesystem,3scale,azure", help="comma separated sources - filesystem, 3scale and azure")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.01, help="the latency in seconds of every Imperva call")
+    parser.add_argument("--error-rate", type=float, default=0, help="the rate of Imperva calls which fail with HTTP 500")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="the rate of Imperva calls which are throttled with HTTP 429")
+    parser.add_argument("--retry-after", type=int, default=None, help="the Retry-After header of the throttled calls")
+    parser.add_argument("--concurrency", type=int, default=8, help="the sync concurrency of the manager")
+    parser.add_argument("--rps", type=float, default=1000, help="the request rate of the manager")
+    parser.add_argument("--output", help="a file to write the results to as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the errors of the manager")
+    args = parser.parse_args()
+    mock_server = start_mock_server(args)
+    all_results = []
+    try:
+        print_header()
+        for source in args.sources.split(","):
+            for total_apis in [int(size) for size in args.sizes.split(",")]:
+                work_path = tempfile.mkdtemp(prefix="benchmark-")
+                try:
+                    all_results.extend(run_benchmark(args, work_path, source, total_apis))
+                finally:
+                    shutil.rmtree(work_path, ignore_errors=True)
+    finally:
+        mock_server.kill()
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(all_results, outfile, indent=2)
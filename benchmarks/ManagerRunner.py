@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import os
+import runpy
+import sys
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+
+# runs the API Security Manager as is, except that the calls to the 3Scale and Azure hosts are sent to the local mock server
+MOCK_URL = urlsplit(os.environ.get("BENCH_MOCK_URL", "http://127.0.0.1:8765"))
+MOCKED_HOSTS = (".management.azure-api.net", "bench.3scale.net")
+SOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+send_request = requests.Session.request
+
+
+def send_mocked_request(session, method, url, *args, **kwargs):
+    url_parts = urlsplit(url)
+    if url_parts.hostname is not None and url_parts.hostname.endswith(MOCKED_HOSTS):
+        url = urlunsplit((MOCK_URL.scheme, MOCK_URL.netloc, url_parts.path, url_parts.query, url_parts.fragment))
+    return send_request(session, method, url, *args, **kwargs)
+
+
+if __name__ == "__main__":
+    requests.Session.request = send_mocked_request
+    sys.path.insert(0, SOURCE_PATH)
+    sys.argv = [os.path.join(SOURCE_PATH, "ApiSecurityManager.py")] + sys.argv[1:]
+    runpy.run_path(sys.argv[0], run_name="__main__")
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import argparse
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from SpecCorpus import create_api_spec
+
+# a stand-in of the Imperva management API, the 3Scale ActiveDocs API and the Azure API Management API for the benchmarks
+
+
+class MockState:
+
+    def __init__(self, latency, error_rate, throttle_rate, retry_after):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.reset(0, 0)
+
+
+    def reset(self, source_apis, revision):
+        with self.lock:
+            # the Imperva side - API ID to (site ID, host, base path, last modified)
+            self.apis = dict()
+            self.next_api_id = 1
+            self.listing_version = 0
+            # the 3Scale and Azure side - generated on demand from the same corpus as the filesystem specs
+            self.source_apis = source_apis
+            self.revision = revision
+            self.stats = {"requests": 0, "list": 0, "post": 0, "delete": 0, "throttled": 0, "errors": 0, "not_modified": 0, "bytes_received": 0, "sources": 0}
+
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        state = self.server.state
+        if url.path == "/_bench/stats":
+            return self.send_json(200, state.stats)
+        if url.path.startswith("/admin/api/active_docs.json"):
+            return self.get_active_docs(query)
+        if "/providers/Microsoft.ApiManagement/" in url.path:
+            return self.get_azure(url.path, query)
+        if url.path.startswith("/blobs/"):
+            return self.get_blob(url.path)
+        if self.imperva_call():
+            return
+        state.count("list")
+        with state.lock:
+            etag = '"%d"' % state.listing_version
+            if self.headers.get("If-None-Match") == etag:
+                state.stats["not_modified"] += 1
+                return self.send_body(304, b"", {"ETag": etag})
+            api_listing = [{"id": api_id, "siteId": int(site_id), "hostName": host, "basePath": base_path, "lastModified": last_modified}
+                           for api_id, (site_id, host, base_path, last_modified) in state.apis.items()]
+        return self.send_json(200, {"value": api_listing, "isError": False}, {"ETag": etag})
+
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        state = self.server.state
+        if url.path == "/_bench/reset":
+            settings = json.loads(self.read_body().decode("utf-8") or "{}")
+            state.reset(settings.get("source_apis", 0), settings.get("revision", 0))
+            return self.send_json(200, {})
+        if url.path == "/_bench/revision":
+            # changes all the 3Scale and Azure specs while keeping the APIs at the Imperva side
+            settings = json.loads(self.read_body().decode("utf-8") or "{}")
+            with state.lock:
+                state.revision = settings["revision"]
+            return self.send_json(200, {})
+        body = self.read_body()
+        if self.imperva_call():
+            return
+        state.count("post")
+        state.count("bytes_received", len(body))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        api_spec = self.read_api_spec(body)
+        if api_spec is None:
+            return self.send_json(400, {"isError": True, "message": "no API specification"})
+        path = url.path.strip("/").split("/")
+        with state.lock:
+            state.listing_version += 1
+            if len(path) >= 4:
+                api_id = int(path[-1])
+                site_id = path[-2]
+            else:
+                api_id = state.next_api_id
+                state.next_api_id += 1
+                site_id = path[-1]
+            state.apis[api_id] = (site_id, api_spec.get("host", ""), api_spec.get("basePath", ""), int(time.time() * 1000))
+        return self.send_json(200, {"value": api_id, "isError": False})
+
+
+    def do_DELETE(self):
+        state = self.server.state
+        if self.imperva_call():
+            return
+        state.count("delete")
+        api_id = int(urlparse(self.path).path.rstrip("/").split("/")[-1])
+        with state.lock:
+            state.listing_version += 1
+            state.apis.pop(api_id, None)
+        return self.send_json(200, {"isError": False})
+
+
+    def imperva_call(self):
+        # the latency, errors and throttling apply to the calls to the Imperva management API only
+        state = self.server.state
+        state.count("requests")
+        if state.latency:
+            time.sleep(state.latency)
+        if state.throttle_rate and random.random() < state.throttle_rate:
+            state.count("throttled")
+            headers = {"Retry-After": str(state.retry_after)} if state.retry_after is not None else None
+            self.send_json(429, {"isError": True, "message": "too many requests"}, headers)
+            return True
+        if state.error_rate and random.random() < state.error_rate:
+            state.count("errors")
+            self.send_json(500, {"isError": True, "message": "internal error"})
+            return True
+        return False
+
+
+    def read_api_spec(self, body):
+        # the API spec is the apiSpecification field of the multipart form
+        boundary = re.search(r"multipart/form-data;.*boundary=\"?([^\";]+)", self.headers.get("Content-Type", ""))
+        if boundary is None:
+            return None
+        for part in body.split(b"--" + boundary.group(1).encode("ascii")):
+            if b'name="apiSpecification"' in part.split(b"\r\n\r\n", 1)[0]:
+                content = part.split(b"\r\n\r\n", 1)[1].rstrip(b"\r\n")
+                host = re.search(rb'"host"\s*:\s*"([^"]*)"', content)
+                base_path = re.search(rb'"basePath"\s*:\s*"([^"]*)"', content)
+                return {"host": host.group(1).decode("utf-8") if host else "", "basePath": base_path.group(1).decode("utf-8") if base_path else ""}
+        return None
+
+
+    def get_active_docs(self, query):
+        state = self.server.state
+        state.count("sources")
+        page = int(query.get("page", ["1"])[0])
+        per_page = int(query.get("per_page", ["100"])[0])
+        first = (page - 1) * per_page
+        api_docs = [{"api_doc": {"id": index, "name": "api%d" % index, "updated_at": "2020-01-01T00:00:%02dZ" % (state.revision % 60),
+                                 "body": json.dumps(create_api_spec(index, state.revision))}}
+                    for index in range(first, min(first + per_page, state.source_apis))]
+        return self.send_json(200, {"api_docs": api_docs})
+
+
+    def get_azure(self, path, query):
+        state = self.server.state
+        state.count("sources")
+        api_match = re.search(r"/apis/([^/?]+)$", path)
+        if api_match is not None:
+            return self.send_json(200, {"link": "http://%s:%d/blobs/%s" % (self.server.server_address[0], self.server.server_address[1], api_match.group(1))})
+        skip = int(query.get("$skip", ["0"])[0])
+        apis = [{"id": "/apis/api%d" % index, "name": "api%d" % index, "properties": {"apiRevision": str(state.revision + 1), "path": "api%d" % index}}
+                for index in range(skip, min(skip + 100, state.source_apis))]
+        apis_page = {"value": apis}
+        if skip + 100 < state.source_apis:
+            apis_page["nextLink"] = "https://bench.management.azure-api.net%s?api-version=2018-06-01-preview&$skip=%d" % (path, skip + 100)
+        return self.send_json(200, apis_page)
+
+
+    def get_blob(self, path):
+        state = self.server.state
+        state.count("sources")
+        index = int(path.rsplit("api", 1)[1])
+        etag = '"%d-%d"' % (index, state.revision)
+        if self.headers.get("If-None-Match") == etag:
+            return self.send_body(304, b"", {"ETag": etag})
+        return self.send_body(200, json.dumps(create_api_spec(index, state.revision)).encode("utf-8"), {"ETag": etag, "Content-Type": "application/json"})
+
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+
+    def send_json(self, status_code, response_json, headers=None):
+        return self.send_body(status_code, json.dumps(response_json).encode("utf-8"), dict(headers or dict(), **{"Content-Type": "application/json"}))
+
+
+    def send_body(self, status_code, body, headers=None):
+        self.send_response(status_code)
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A local stand-in of the Imperva, 3Scale and Azure APIs for the benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0, help="the latency in seconds of every Imperva call")
+    parser.add_argument("--error-rate", type=float, default=0, help="the rate of Imperva calls which fail with HTTP 500")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="the rate of Imperva calls which are throttled with HTTP 429")
+    parser.add_argument("--retry-after", type=int, default=None, help="the Retry-After header of the throttled calls")
+    args = parser.parse_args()
+    server = MockServer((args.host, args.port), MockHandler)
+    server.state = MockState(args.latency, args.error_rate, args.throttle_rate, args.retry_after)
+    server.serve_forever()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import json
+import os
+
+import yaml
+
+
+def create_api_spec(index, revision=0, paths=10):
+    # a swagger 2.0 spec with a few paths, so the specs have a realistic size - the revision changes the spec without changing its key
+    api_spec = {
+        "swagger": "2.0",
+        "info": {"title": "Benchmark API %d" % index, "version": "1.%d" % revision},
+        "host": "api%d.bench.example.com" % index,
+        "basePath": "/v1",
+        "schemes": ["https"],
+        "paths": dict()
+    }
+    for path_index in range(paths):
+        api_spec["paths"]["/resource%d/{id}" % path_index] = {
+            "get": {
+                "operationId": "getResource%d" % path_index,
+                "parameters": [
+                    {"name": "id", "in": "path", "required": True, "type": "string"},
+                    {"name": "limit", "in": "query", "required": False, "type": "integer", "format": "int32"}
+                ],
+                "responses": {"200": {"description": "The resource", "schema": {"type": "object", "properties": {"id": {"type": "string"}, "name": {"type": "string"}}}}}
+            }
+        }
+    return api_spec
+
+
+def write_filesystem_corpus(path, total_apis, revision=0, yaml_ratio=0.2):
+    # most of the files are JSON and some are YAML, like a typical specs repository
+    if not os.path.exists(path):
+        os.makedirs(path)
+    yaml_every = int(1 / yaml_ratio) if yaml_ratio else 0
+    for index in range(total_apis):
+        api_spec = create_api_spec(index, revision)
+        sub_dir = os.path.join(path, "team%d" % (index % 10))
+        if not os.path.exists(sub_dir):
+            os.makedirs(sub_dir)
+        if yaml_every and index % yaml_every == 0:
+            with open(os.path.join(sub_dir, "api%d.yaml" % index), 'w') as outfile:
+                yaml.safe_dump(api_spec, outfile)
+        else:
+            with open(os.path.join(sub_dir, "api%d.json" % index), 'w') as outfile:
+                json.dump(api_spec, outfile, indent=2)
@@ -7,33 +7,91 @@
 ##################################################
 #
 
+import cProfile
 import getopt
+import gzip
 import importlib
 import json
 import logging
 import os
+import queue
+import shutil
+import signal
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from logging import handlers
 
 import requests
 
 from config.Config import Config
+from utils.ApiIndex import ApiIndex
+from utils.ImpervaClient import ImpervaClient
+from utils.LogPipeline import JsonFormatter, LazyJson, LogQueueHandler, ResponseBody, flush_logs, set_max_body_size
+from utils.Metrics import Metrics, start_metrics_server
+from utils.SnapshotStore import SnapshotStore
+from utils.StateStore import StateStore
 from utils.Status import Status
+from utils.SpecQuarantine import SpecQuarantine
+from utils.SpecSpool import SpecSpool
+from utils.SpecTransform import SpecTransform
+from utils.SpecValidator import SpecValidator
+from utils.SyncExecutor import SyncExecutor
+from utils.WebhookListener import WebhookListener
+
+# the fetchers report that they are done through the same queue as the API specs
+FETCHER_SUCCEEDED = object()
+FETCHER_FAILED = object()
 
 
 class ApiSecurityManager:
 
-    def __init__(self, path_to_conf_file, conf_json):
+    def __init__(self, path_to_conf_file, conf_json, site=None):
         self.config = None
         self.logger = None
+        config_load_start = time.monotonic()
         self.config = self.set_config(path_to_conf_file, conf_json)
+        self.config_load_time = time.monotonic() - config_load_start
+        if site is not None:
+            self.config = self.config.for_site(site)
         self.logger = self.set_log(self.config.LOG_PATH, self.config.LOG_LEVEL)
         self.existing_apis = dict()
-        self.status = Status(self.logger)
+        self.existing_api_versions = dict()
+        self.status = self.new_status()
+        self.state_store = StateStore(self.config.STATE_PATH, self.config.SITE_ID, self.logger)
+        self.api_index = ApiIndex(self.config.STATE_PATH, self.config.SITE_ID, self.logger)
+        self.spec_quarantine = SpecQuarantine(self.config.STATE_PATH, self.config.SITE_ID, self.logger)
+        self.spec_validator = SpecValidator(self.config.VALIDATION_WORKERS) if self.config.VALIDATION_ENABLED else None
+        self.snapshot_store = SnapshotStore(self.config.SNAPSHOT_PATH, self.logger)
+        self.client = ImpervaClient(self.config, self.logger)
+        self.spec_transform = SpecTransform(self.config.TRANSFORM)
+        # the uploads are compressed until the server reports that it doesn't support compressed requests
+        self.compress_uploads = self.config.TRANSFORM_COMPRESS
+        # the metrics of the current run, and of the last finished run which are served to Prometheus
+        self.metrics = Metrics()
+        self.reported_metrics = self.metrics
+        # the configuration file is watched by the daemon, unless the configuration JSON was given on the command line
+        self.path_to_conf_file = path_to_conf_file if conf_json is None else None
+        self.config_mtime = self.get_config_mtime()
+        self.stopped = threading.Event()
+        # the cycles of the daemon and the syncs of the webhook events never run at the same time
+        self.sync_lock = threading.Lock()
+        # the time until which operations are started - the rest are deferred to the next run
+        self.sync_deadline = None
+        # the daemon remembers when the existing APIs were read, when every fetcher last ran and which APIs it fetched
+        self.existing_apis_read_time = None
+        self.fetcher_run_times = dict()
+        self.fetcher_api_keys = dict()
 
 
     def protect_apis_with_imperva(self):
+        if self.config.SITES is not None:
+            return self.protect_sites_with_imperva()
         self.logger.info("Starting to run the API Security Manager")
+        self.start_metrics()
+        self.sync_deadline = self.get_sync_deadline()
         # Check for existing APIs at Imperva
         successfully_read_existing_apis = self.read_apis()
         if not successfully_read_existing_apis:
@@ -41,128 +99,841 @@ class ApiSecurityManager:
             self.logger.error("Exiting since we failed to read the existing APIs for site ID %s", self.config.SITE_ID)
             sys.exit(1)
         else:
-            # Fetch the API specifications from the desired API management platform or filesystem
-            fetched_api_specs = self.fetch_api_specs()
-            if len(fetched_api_specs) > 0:
-                # Upload newly found APIs and update existing APIs
-                self.upload_and_update_apis(fetched_api_specs)
-            # Check for APIs which are previously added to Imperva but were not fetched this time - therefore they should be deleted now since they no longer exists
-            self.delete_apis(fetched_api_specs)
+            # Load the digests of the API specs which were already pushed to Imperva in previous runs
+            self.state_store.load()
+            self.spec_quarantine.load()
+            if not self.sync_apis(self.get_active_fetchers()):
+                sys.exit(1)
             run_status = self.status.calculate_status()
-            self.status.report_status(self.config.STATUS_PATH)
-            self.logger.info("Finished updating the API security manager - The status is %s", json.dumps(self.status.get_status()))
+            self.report_metrics()
+            status_report = self.report_status()
+            self.logger.info("Finished updating the API security manager - The status is %s", LazyJson(status_report))
             self.logger.info("Successfully finished running the API Security Manager")
             return run_status
 
 
-    def fetch_api_specs(self):
-        self.logger.info("Trying to fetch API specs")
-        api_specs = dict()
-        for fetcher in self.config.FETCHERS:
-            if fetcher["active"]:
-                try:
-                    Fetcher = getattr(importlib.import_module("fetchers." + fetcher["type"]), fetcher["type"])
-                    fetched_apis = Fetcher.fetch(fetcher["settings"], self.logger)
-                    if fetched_apis is not None:
-                        api_specs.update(fetched_apis)
-                except Exception as ex:
-                    self.logger.error("Failed to fetch APIs from %s. Error is %s", fetcher["type"], ex)
-                    self.status.update_fetcher_error(fetcher["type"])
-                self.status.update_fetcher_success(fetcher["type"])
-        if len(api_specs) == 0:
+    def protect_sites_with_imperva(self):
+        self.logger.info("Starting to run the API Security Manager for %d sites", len(self.config.SITES))
+        run_start = time.monotonic()
+        self.start_metrics()
+        # the fetched API specs are spooled to the disk, so every fetcher runs once for all the sites
+        if self.config.STATE_PATH and not os.path.exists(self.config.STATE_PATH):
+            os.makedirs(self.config.STATE_PATH)
+        spool_path = tempfile.mkdtemp(prefix="spool-", dir=self.config.STATE_PATH or None)
+        try:
+            spooled_fetchers = self.spool_api_specs(spool_path)
+            site_workers = min(self.config.SITE_WORKERS, len(self.config.SITES))
+            conf_json = json.dumps(self.config.config_json)
+            site_results = []
+            # the sites are synced in parallel, every site in its own process with its own client, state and status
+            with ProcessPoolExecutor(max_workers=site_workers) as executor:
+                futures = []
+                for site in self.config.SITES:
+                    site_fetcher_ids = Config.get_site_fetcher_ids(site, self.config.FETCHERS)
+                    site_fetchers = [dict(spooled_fetcher, spool=dict(spooled_fetcher["spool"], key_filter=site.get("key_filter")))
+                                     for spooled_fetcher in spooled_fetchers if spooled_fetcher["spool"]["fetcher_id"] in site_fetcher_ids]
+                    futures.append(executor.submit(sync_site, conf_json, site, site_fetchers))
+                for site, future in zip(self.config.SITES, futures):
+                    try:
+                        site_results.append(future.result())
+                    except Exception as ex:
+                        self.logger.error("Failed to sync site ID %s. Error is %s", site["site_id"], ex)
+                        site_results.append((site["site_id"], 1, None))
+        finally:
+            shutil.rmtree(spool_path, ignore_errors=True)
+        run_status = max(site_status for site_id, site_status, status in site_results)
+        self.report_sites_status(site_results)
+        self.logger.info("Finished running the API Security Manager for %d sites in %.2f seconds - %d sites had errors",
+                         len(site_results), time.monotonic() - run_start, sum(1 for site_id, site_status, status in site_results if site_status != 0))
+        return run_status
+
+
+    def spool_api_specs(self, spool_path):
+        used_fetcher_ids = set()
+        for site in self.config.SITES:
+            used_fetcher_ids.update(Config.get_site_fetcher_ids(site, self.config.FETCHERS))
+        fetchers = [(precedence, fetcher) for precedence, fetcher in self.get_active_fetchers() if Config.get_fetcher_id(fetcher) in used_fetcher_ids]
+        fetcher_statuses = [Status(self.logger) for fetcher in fetchers]
+        spec_spool = SpecSpool(spool_path, self.logger)
+        try:
+            for precedence, host_and_base_path, api_spec in self.fetch_api_specs(fetchers, fetcher_statuses):
+                spec_spool.add("fetcher_%d" % precedence, host_and_base_path, api_spec)
+        finally:
+            spec_spool.close()
+        # every site gets the fetchers it uses, in their original order, reading the spooled API specs instead of fetching them again
+        spooled_fetchers = []
+        for (precedence, fetcher), fetcher_status in zip(fetchers, fetcher_statuses):
+            fetchers_status = fetcher_status.get_status()["fetchers"]
+            spooled_fetchers.append(dict(fetcher, spool={"spool_path": spool_path, "listing": "fetcher_%d" % precedence, "fetcher_id": Config.get_fetcher_id(fetcher),
+                                                         "fetcher_type": fetcher["type"], "failed": len(fetchers_status["error"]) > 0,
+                                                         "snapshot": len(fetchers_status["snapshot"]) > 0, "regions": fetchers_status["regions"]}))
+        return spooled_fetchers
+
+
+    def report_sites_status(self, site_results):
+        # the aggregated status of all the sites - the full status of every site is in its own status file
+        sites_status = Status(self.logger)
+        sites_status.status = {"time": int(round(time.time() * 1000)), "has_errors": any(site_status != 0 for site_id, site_status, status in site_results), "sites": dict()}
+        # the metrics of the shared fetch - the metrics of every site are in its own status file
+        self.report_metrics()
+        sites_status.set_metrics(self.status.get_status()["metrics"])
+        for site_id, site_status, status in site_results:
+            site_summary = {"has_errors": site_status != 0}
+            if status is not None:
+                site_summary["apis"] = status["apis"]
+                site_summary["fetchers"] = status["fetchers"]
+            sites_status.status["sites"][site_id] = site_summary
+        sites_status.report_status(self.config.STATUS_PATH, self.config.STATUS_FILE_NAME)
+
+
+    def run_daemon(self):
+        if self.config.SITES is not None:
+            self.logger.error("Exiting since the daemon mode supports a single site - run a daemon for every site")
+            return 1
+        self.logger.info("Starting to run the API Security Manager as a daemon")
+        # the state, the client and the existing APIs are kept between the cycles, so every cycle only pushes what changed
+        self.state_store.load()
+        self.spec_quarantine.load()
+        webhook_listener = None
+        if self.config.WEBHOOK_PORT:
+            webhook_listener = WebhookListener(self.config.WEBHOOK_HOST, self.config.WEBHOOK_PORT, self.config.WEBHOOK_TOKEN, self.config.WEBHOOK_COALESCE_DELAY,
+                                               self.is_active_fetcher, self.sync_api_events, self.logger)
+            webhook_listener.start()
+        metrics_server = None
+        if self.config.METRICS_PORT:
+            # serves the metrics of the last finished cycle
+            metrics_server = start_metrics_server(self.config.METRICS_HOST, self.config.METRICS_PORT, lambda: self.reported_metrics)
+        while not self.stopped.is_set():
+            with self.sync_lock:
+                self.reload_config()
+                due_fetchers = self.get_due_fetchers()
+                if len(due_fetchers) > 0:
+                    try:
+                        self.run_profiled(self.run_cycle, due_fetchers)
+                    except Exception as ex:
+                        # the daemon keeps running - the next cycle starts from a fresh read of the existing APIs
+                        self.logger.error("Unexpected error while running the sync cycle - error is '%s'", ex)
+                        self.existing_apis_read_time = None
+            self.stopped.wait(self.get_next_cycle_delay())
+        if webhook_listener is not None:
+            webhook_listener.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if self.spec_validator is not None:
+            self.spec_validator.close()
+        self.logger.info("Stopped running the API Security Manager")
+        return 0
+
+
+    def run_cycle(self, due_fetchers):
+        cycle_start = time.monotonic()
+        self.logger.info("Starting a sync cycle for %s", ", ".join(Config.get_fetcher_id(fetcher) for precedence, fetcher in due_fetchers))
+        self.status = self.new_status()
+        self.start_metrics()
+        self.sync_deadline = self.get_sync_deadline()
+        # the existing APIs are read again periodically, so changes which were made directly in Imperva are noticed
+        if self.existing_apis_read_time is None or cycle_start - self.existing_apis_read_time >= self.config.DAEMON_FULL_READ_INTERVAL:
+            if not self.read_apis():
+                self.logger.error("Skipping the sync cycle since we failed to read the existing APIs for site ID %s", self.config.SITE_ID)
+                self.existing_apis_read_time = None
+                return
+            self.existing_apis_read_time = cycle_start
+        for precedence, fetcher in due_fetchers:
+            self.fetcher_run_times[Config.get_fetcher_id(fetcher)] = cycle_start
+        if not self.sync_apis(due_fetchers):
+            return
+        run_status = self.status.calculate_status()
+        if run_status != 0:
+            # some of the APIs may have been changed at Imperva even though the requests failed, so they are read again on the next cycle
+            self.existing_apis_read_time = None
+        self.report_metrics()
+        status_report = self.report_status()
+        self.logger.info("Finished the sync cycle in %.2f seconds - The status is %s", time.monotonic() - cycle_start, LazyJson(status_report))
+
+
+    def sync_api_events(self, changed_sources, uploaded_api_specs):
+        # syncs only the APIs of the webhook events - the cycles of the daemon still sync everything
+        with self.sync_lock:
+            sync_start = time.monotonic()
+            self.logger.info("Starting to sync the webhook events of %d sources and %d API specs", len(changed_sources), len(uploaded_api_specs))
+            self.status = self.new_status()
+            self.start_metrics()
+            self.sync_deadline = None
+            if self.existing_apis_read_time is None:
+                if not self.read_apis():
+                    self.logger.error("Skipping the webhook events since we failed to read the existing APIs for site ID %s", self.config.SITE_ID)
+                    return
+                self.existing_apis_read_time = sync_start
+            active_fetchers = dict((Config.get_fetcher_id(fetcher), (precedence, fetcher)) for precedence, fetcher in self.get_active_fetchers())
+            # the sources are synced before the uploaded API specs, so an uploaded API spec is the last one pushed and it is not deleted
+            # by the sync of its source, which doesn't have it yet
+            for source, changed_keys in changed_sources.items():
+                if source in active_fetchers:
+                    uploaded_keys = set(host_and_base_path for host_and_base_path, (uploaded_source, api_spec) in uploaded_api_specs.items() if uploaded_source == source)
+                    self.sync_source(source, active_fetchers[source], changed_keys, uploaded_keys)
+            with SyncExecutor(self.config.CONCURRENCY, self.client, self.status, self.logger, self.sync_deadline) as sync_executor:
+                for host_and_base_path, (source, api_spec) in uploaded_api_specs.items():
+                    if source not in active_fetchers or self.is_overridden(host_and_base_path, active_fetchers[source][0]):
+                        self.logger.info("Skipping the API spec for '%s' since %s is not its source", host_and_base_path, source)
+                        continue
+                    # the API is kept as an API of its source until the source is fetched again
+                    self.fetcher_api_keys.setdefault(source, set()).add(host_and_base_path)
+                    self.upload_or_update_api(sync_executor, host_and_base_path, api_spec)
+            self.state_store.save()
+            self.spec_quarantine.save()
+            run_status = self.status.calculate_status()
+            if run_status != 0:
+                self.existing_apis_read_time = None
+            self.report_metrics()
+            status_report = self.report_status()
+            self.logger.info("Finished syncing the webhook events in %.2f seconds - The status is %s", time.monotonic() - sync_start, LazyJson(status_report))
+
+
+    def sync_source(self, source, precedence_and_fetcher, changed_keys, uploaded_keys=()):
+        # the source is fetched again, but only the changed APIs are pushed - all of them when the changed keys are not known
+        precedence, fetcher = precedence_and_fetcher
+        self.fetcher_run_times[source] = time.monotonic()
+        fetched_keys = set()
+        with self.metrics.phase("upload_and_update"), SyncExecutor(self.config.CONCURRENCY, self.client, self.status, self.logger, self.sync_deadline) as sync_executor:
+            for fetched_precedence, host_and_base_path, api_spec in self.fetch_api_specs([precedence_and_fetcher]):
+                if host_and_base_path in fetched_keys:
+                    continue
+                fetched_keys.add(host_and_base_path)
+                if (changed_keys is None or host_and_base_path in changed_keys) and not self.is_overridden(host_and_base_path, precedence):
+                    self.upload_or_update_api(sync_executor, host_and_base_path, api_spec)
+        if len(self.status.get_status()["fetchers"]["error"]) > 0:
+            # nothing is deleted when the source failed, since its APIs are not known
+            return
+        removed_keys = (changed_keys if changed_keys is not None else self.fetcher_api_keys.get(source, set())) - fetched_keys - set(uploaded_keys)
+        self.fetcher_api_keys[source] = fetched_keys
+        if self.client.circuit_breaker.is_open():
+            self.logger.error("Skipping the deletion of APIs since the Imperva management URL for site ID %s is unavailable", self.config.SITE_ID)
+            return
+        with self.metrics.phase("delete"), SyncExecutor(self.config.CONCURRENCY, self.client, self.status, self.logger, self.sync_deadline) as sync_executor:
+            for host_and_base_path in removed_keys:
+                if host_and_base_path in self.existing_apis and not self.is_overridden(host_and_base_path, -1):
+                    self.logger.info("API ID %d for '%s' was removed from %s and therefore will be deleted from Imperva", self.existing_apis[host_and_base_path], host_and_base_path, source)
+                    self.state_store.plan("deleted", host_and_base_path)
+                    sync_executor.submit("deleted", host_and_base_path, self.delete_api, self.existing_apis[host_and_base_path])
+
+
+    def is_overridden(self, host_and_base_path, precedence):
+        # whether an active fetcher with a higher precedence has this API since its last run
+        for fetcher_precedence, fetcher in self.get_active_fetchers():
+            if fetcher_precedence > precedence and host_and_base_path in self.fetcher_api_keys.get(Config.get_fetcher_id(fetcher), ()):
+                return True
+        return False
+
+
+    def is_active_fetcher(self, source):
+        return any(Config.get_fetcher_id(fetcher) == source for precedence, fetcher in self.get_active_fetchers())
+
+
+    def stop(self):
+        # the current cycle is finished before the daemon stops
+        self.stopped.set()
+
+
+    def sync_apis(self, fetchers):
+        # the APIs of the active fetchers which don't run now are kept, with their precedence, as they were last fetched
+        fetching = set(precedence for precedence, fetcher in fetchers)
+        fetched_api_keys = dict()
+        for precedence, fetcher in self.get_active_fetchers():
+            if precedence not in fetching:
+                for host_and_base_path in self.fetcher_api_keys.get(Config.get_fetcher_id(fetcher), ()):
+                    fetched_api_keys[host_and_base_path] = max(precedence, fetched_api_keys.get(host_and_base_path, precedence))
+        # Fetch the API specifications from the desired API management platform or filesystem,
+        # and upload newly found APIs and update existing APIs while they are being fetched
+        fetched_keys_by_precedence = dict((precedence, set()) for precedence, fetcher in fetchers)
+        fetched_api_specs = self.remember_fetched_keys(self.fetch_api_specs(fetchers), fetched_keys_by_precedence)
+        fetched_api_keys = self.upload_and_update_apis(fetched_api_specs, fetched_api_keys)
+        if len(fetched_api_keys) == 0:
             self.logger.error("Failed to fetch API specs")
-            sys.exit(1)
-        return api_specs
+            return False
+        for precedence, fetcher in fetchers:
+            self.fetcher_api_keys[Config.get_fetcher_id(fetcher)] = fetched_keys_by_precedence[precedence]
+        if self.client.circuit_breaker.is_open():
+            # Stop early since the Imperva management URL is down - the APIs will be synced on the next run
+            self.logger.error("Skipping the deletion of APIs since the Imperva management URL for site ID %s is unavailable", self.config.SITE_ID)
+        else:
+            # Check for APIs which are previously added to Imperva but were not fetched this time - therefore they should be deleted now since they no longer exists
+            self.delete_apis(fetched_api_keys)
+        self.state_store.save()
+        deferred_operations = self.status.get_deferred_count()
+        # only a complete sync of all the active fetchers knows which of the quarantined API specs are gone
+        complete_sync = len(fetchers) == len(self.get_active_fetchers()) and len(self.status.get_status()["fetchers"]["error"]) == 0 and deferred_operations == 0
+        self.spec_quarantine.save(prune=complete_sync)
+        if deferred_operations > 0:
+            self.logger.warning("The time budget of the run is over - %d operations were deferred to the next run", deferred_operations)
+        return True
+
+
+    def remember_fetched_keys(self, fetched_api_specs, fetched_keys_by_precedence):
+        for precedence, host_and_base_path, api_spec in fetched_api_specs:
+            fetched_keys_by_precedence[precedence].add(host_and_base_path)
+            yield precedence, host_and_base_path, api_spec
+
+
+    def get_sync_deadline(self):
+        if self.config.TIME_BUDGET is None:
+            return None
+        return time.monotonic() + self.config.TIME_BUDGET
+
+
+    def get_active_fetchers(self):
+        # the position of a fetcher in the list is its precedence - when a few fetchers return the same API the last one in the list wins
+        return [(precedence, fetcher) for precedence, fetcher in enumerate(self.config.FETCHERS) if fetcher["active"]]
+
+
+    def get_fetcher_schedule(self, fetcher):
+        return fetcher.get("schedule", self.config.DAEMON_INTERVAL)
+
+
+    def get_due_fetchers(self):
+        now = time.monotonic()
+        return [(precedence, fetcher) for precedence, fetcher in self.get_active_fetchers()
+                if Config.get_fetcher_id(fetcher) not in self.fetcher_run_times or now - self.fetcher_run_times[Config.get_fetcher_id(fetcher)] >= self.get_fetcher_schedule(fetcher)]
+
+
+    def get_next_cycle_delay(self):
+        # wake up when the next fetcher is due, and at least once an interval so a changed configuration is noticed
+        now = time.monotonic()
+        next_cycle = now + self.config.DAEMON_INTERVAL
+        for precedence, fetcher in self.get_active_fetchers():
+            fetcher_run_time = self.fetcher_run_times.get(Config.get_fetcher_id(fetcher))
+            if fetcher_run_time is not None:
+                next_cycle = min(next_cycle, fetcher_run_time + self.get_fetcher_schedule(fetcher))
+        return max(1, next_cycle - now)
+
+
+    def get_config_mtime(self):
+        if self.path_to_conf_file is None:
+            return None
+        try:
+            return os.stat(self.path_to_conf_file).st_mtime_ns
+        except OSError:
+            return None
+
+
+    def reload_config(self):
+        config_mtime = self.get_config_mtime()
+        if config_mtime is None or config_mtime == self.config_mtime:
+            return
+        self.config_mtime = config_mtime
+        try:
+            config_load_start = time.monotonic()
+            config = Config(self.path_to_conf_file, None).read()
+            self.config_load_time = time.monotonic() - config_load_start
+        except Exception:
+            self.logger.error("Failed to reload the configuration file '%s' - keep running with the previous configuration", self.path_to_conf_file)
+            return
+        self.logger.info("The configuration file '%s' was changed - reloading it", self.path_to_conf_file)
+        previous_config = self.config
+        self.config = config
+        self.set_log_level(self.logger, config.LOG_LEVEL)
+        self.spec_transform = SpecTransform(config.TRANSFORM)
+        self.compress_uploads = config.TRANSFORM_COMPRESS
+        self.snapshot_store = SnapshotStore(config.SNAPSHOT_PATH, self.logger)
+        if config.config_json.get("validation") != previous_config.config_json.get("validation"):
+            if self.spec_validator is not None:
+                self.spec_validator.close()
+            self.spec_validator = SpecValidator(config.VALIDATION_WORKERS) if config.VALIDATION_ENABLED else None
+        # the client is created again only when its settings were changed, otherwise its connections are kept
+        if (config.MANAGEMENT_URL, config.API_ID, config.API_KEY, config.CONCURRENCY, config.config_json.get("client")) != \
+                (previous_config.MANAGEMENT_URL, previous_config.API_ID, previous_config.API_KEY, previous_config.CONCURRENCY, previous_config.config_json.get("client")):
+            self.client = ImpervaClient(config, self.logger)
+        if (config.MANAGEMENT_URL, config.SITE_ID, config.STATE_PATH) != (previous_config.MANAGEMENT_URL, previous_config.SITE_ID, previous_config.STATE_PATH):
+            # a different site - nothing that is known about the previous site is relevant for it
+            self.state_store = StateStore(config.STATE_PATH, config.SITE_ID, self.logger)
+            self.state_store.load()
+            self.api_index = ApiIndex(config.STATE_PATH, config.SITE_ID, self.logger)
+            self.spec_quarantine = SpecQuarantine(config.STATE_PATH, config.SITE_ID, self.logger)
+            self.spec_quarantine.load()
+            self.existing_apis_read_time = None
+            self.fetcher_run_times = dict()
+            self.fetcher_api_keys = dict()
+
+
+    def fetch_api_specs(self, fetchers, fetcher_statuses=None):
+        self.logger.info("Trying to fetch API specs")
+        # every fetcher can report to its own status, otherwise they all report to the status of the run
+        fetcher_statuses = fetcher_statuses or [self.status] * len(fetchers)
+        # a bounded queue, so the fetchers wait for the uploads instead of keeping all the API specs in memory
+        fetched_queue = queue.Queue(maxsize=self.config.CONCURRENCY * 2)
+        cancelled_fetchers = [False] * len(fetchers)
+        # the keys that every fetcher returned, so only the rest of the APIs are taken from its snapshot if it fails
+        fetched_keys = [set() for fetcher in fetchers]
+        saved_snapshots = False
+        # all the fetchers run at the same time, so the fetch takes as long as the slowest fetcher
+        fetch_start = time.monotonic()
+        deadlines = [fetch_start + fetcher.get("timeout", self.config.FETCH_TIMEOUT) for precedence, fetcher in fetchers]
+        for index, (precedence, fetcher) in enumerate(fetchers):
+            # daemon threads, so a fetcher which is stuck after its deadline won't keep the process alive
+            fetcher_thread = threading.Thread(target=self.run_fetcher, args=(fetcher, index, fetcher_statuses[index], fetched_queue, cancelled_fetchers), name=fetcher["type"], daemon=True)
+            fetcher_thread.start()
+        running_fetchers = set(range(len(fetchers)))
+        while len(running_fetchers) > 0:
+            for index in sorted(running_fetchers):
+                if time.monotonic() >= deadlines[index]:
+                    self.logger.error("Failed to fetch APIs from %s since it did not finish within its deadline", fetchers[index][1]["type"])
+                    fetcher_statuses[index].update_fetcher_error(fetchers[index][1]["type"])
+                    cancelled_fetchers[index] = True
+                    running_fetchers.discard(index)
+                    self.record_fetch_time(fetchers[index][1], fetch_start)
+                    for host_and_base_path, api_spec in self.read_snapshot(fetchers[index][1], fetched_keys[index], fetcher_statuses[index]):
+                        yield fetchers[index][0], host_and_base_path, api_spec
+            if len(running_fetchers) == 0:
+                break
+            try:
+                index, host_and_base_path, api_spec = fetched_queue.get(timeout=max(0, min(deadlines[index] for index in running_fetchers) - time.monotonic()))
+            except queue.Empty:
+                continue
+            if index not in running_fetchers:
+                continue
+            if host_and_base_path is FETCHER_SUCCEEDED:
+                fetcher_statuses[index].update_fetcher_success(fetchers[index][1]["type"])
+                running_fetchers.discard(index)
+                self.record_fetch_time(fetchers[index][1], fetch_start)
+                saved_snapshots = saved_snapshots or "spool" not in fetchers[index][1]
+            elif host_and_base_path is FETCHER_FAILED:
+                fetcher_statuses[index].update_fetcher_error(fetchers[index][1]["type"])
+                running_fetchers.discard(index)
+                self.record_fetch_time(fetchers[index][1], fetch_start)
+                for host_and_base_path, api_spec in self.read_snapshot(fetchers[index][1], fetched_keys[index], fetcher_statuses[index]):
+                    yield fetchers[index][0], host_and_base_path, api_spec
+            else:
+                self.metrics.increment("fetched_apis_total", {"fetcher": Config.get_fetcher_id(fetchers[index][1])})
+                fetched_keys[index].add(host_and_base_path)
+                yield fetchers[index][0], host_and_base_path, api_spec
+        if saved_snapshots and self.snapshot_store.enabled():
+            self.snapshot_store.cleanup()
+        self.logger.info("Finished fetching API specs in %.2f seconds", time.monotonic() - fetch_start)
+
+
+    def record_fetch_time(self, fetcher, fetch_start):
+        # the fetchers run in parallel, so the time of every fetcher is from the start of the fetch until it is done
+        self.metrics.add_phase("fetch:" + Config.get_fetcher_id(fetcher), time.monotonic() - fetch_start)
+
+
+    def run_fetcher(self, fetcher, index, status, fetched_queue, cancelled_fetchers):
+        # the snapshot is saved only when the fetcher succeeds, so a failed fetch never replaces the last successful one
+        snapshot_apis = dict() if self.snapshot_store.enabled() and "spool" not in fetcher else None
+        try:
+            if "spool" in fetcher:
+                # a site of a multi-site run reads the API specs which were already fetched for all the sites
+                Fetcher, settings = SpecSpool, fetcher["spool"]
+            else:
+                Fetcher, settings = getattr(importlib.import_module("fetchers." + fetcher["type"]), fetcher["type"]), fetcher["settings"]
+            for host_and_base_path, api_spec in Fetcher.fetch(settings, self.logger, status):
+                if snapshot_apis is not None:
+                    self.snapshot_store.add(api_spec)
+                    snapshot_apis[host_and_base_path] = api_spec.digest
+                if not self.put_fetched(fetched_queue, cancelled_fetchers, (index, host_and_base_path, api_spec)):
+                    return
+            if snapshot_apis is not None:
+                self.save_snapshot(fetcher, snapshot_apis)
+            self.put_fetched(fetched_queue, cancelled_fetchers, (index, FETCHER_SUCCEEDED, None))
+        except Exception as ex:
+            self.logger.error("Failed to fetch APIs from %s. Error is %s", fetcher["type"], ex)
+            self.put_fetched(fetched_queue, cancelled_fetchers, (index, FETCHER_FAILED, None))
+
+
+    def save_snapshot(self, fetcher, snapshot_apis):
+        fetcher_id = Config.get_fetcher_id(fetcher)
+        added_keys, changed_keys, removed_keys = self.snapshot_store.save(fetcher_id, snapshot_apis)
+        self.logger.info("%s fetched %d APIs - since its last fetch %d APIs were added, %d were changed and %d were removed",
+                         fetcher_id, len(snapshot_apis), len(added_keys), len(changed_keys), len(removed_keys))
+        if len(removed_keys) > 0 and self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("The APIs which were removed from %s are %s", fetcher_id, ", ".join(removed_keys))
+        for change, keys in (("added", added_keys), ("changed", changed_keys), ("removed", removed_keys)):
+            if len(keys) > 0:
+                self.metrics.increment("snapshot_changes_total", {"fetcher": fetcher_id, "change": change}, len(keys))
+
+
+    def read_snapshot(self, fetcher, fetched_keys, status):
+        # the APIs of a failed fetcher are taken from its last successful fetch, so a transient failure of the source won't delete them
+        if not self.snapshot_store.enabled() or "spool" in fetcher:
+            return
+        fetcher_id = Config.get_fetcher_id(fetcher)
+        snapshot = self.snapshot_store.load(fetcher_id)
+        if snapshot is None:
+            self.logger.warning("%s has no snapshot of a successful fetch to use instead of the failed fetch", fetcher_id)
+            return
+        if self.config.SNAPSHOT_MAX_AGE is not None and time.time() - snapshot["time"] > self.config.SNAPSHOT_MAX_AGE:
+            self.logger.warning("The snapshot of %s is older than the snapshot_max_age - it is not used instead of the failed fetch", fetcher_id)
+            return
+        self.logger.warning("Using the snapshot of %s from %s instead of the failed fetch", fetcher_id, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["time"])))
+        status.update_fetcher_snapshot(fetcher["type"])
+        for host_and_base_path, api_spec in self.snapshot_store.read(snapshot, fetched_keys):
+            self.metrics.increment("snapshot_apis_total", {"fetcher": fetcher_id})
+            yield host_and_base_path, api_spec
+
+
+    def put_fetched(self, fetched_queue, cancelled_fetchers, item):
+        # a fetcher which missed its deadline stops instead of waiting forever for room in the queue
+        while not cancelled_fetchers[item[0]]:
+            try:
+                fetched_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
 
     def read_apis(self):
+        with self.metrics.phase("read_apis"):
+            return self.read_existing_apis()
+
+
+    def read_existing_apis(self):
         self.logger.info("Trying to read the existing APIs from Imperva for site ID %s", self.config.SITE_ID)
         try:
-            self.logger.debug("Sending request to Imperva in order to read the current APIs")
-            response = requests.get(self.config.MANAGEMENT_URL + ("?api_id=%s&api_key=%s" %(self.config.API_ID, self.config.API_KEY)), timeout=10)
-            self.logger.debug("Got a response from Imperva\nResponse code is %d, %s\nInfo is '%s'", response.status_code, response.reason, response.text)
-            if response.status_code != 200:
-                self.logger.error("Failed to read the APIs for site ID %s\nResponse code is %d, %s\nInfo is '%s'", self.config.SITE_ID, response.status_code, response.reason, response.text)
-                return False
+            existing_apis = dict()
+            existing_api_versions = dict()
+            if self.config.READ_PAGE_SIZE:
+                # the existing APIs are read page by page until a page is not full
+                page = 1
+                # the IDs of the APIs of all the sites in the listing, since a page may have only APIs of the other sites
+                listed_api_ids = set()
+                while True:
+                    self.logger.debug("Sending request to Imperva in order to read page %d of the current APIs", page)
+                    response = self.client.get(self.client.build_url(), params={"page": page, "page_size": self.config.READ_PAGE_SIZE}, stream=True)
+                    if response.status_code != 200:
+                        self.log_read_apis_error(response)
+                        return False
+                    known_apis = len(listed_api_ids)
+                    page_apis = self.read_api_listing(response, existing_apis, existing_api_versions, listed_api_ids)
+                    # stop if the server ignores the paging and returns the same APIs again
+                    if page_apis < self.config.READ_PAGE_SIZE or len(listed_api_ids) == known_apis:
+                        break
+                    page += 1
             else:
-                response_json = json.loads(response.text)
-                for api_res in response_json["value"]:
-                    self.logger.debug("Found an existing API - %s", api_res)
-                    self.existing_apis[api_res["hostName"] + api_res["basePath"]] = api_res["id"]
-                self.logger.info("Successfully read the existing APIs for site ID %s - Total existing APIs is %d ", self.config.SITE_ID, len(self.existing_apis))
-                return True
-        except requests.exceptions.RequestException as re:
-            self.logger.error("Error while trying to read the APIs for site ID %s\nError is '%s'" , self.config.SITE_ID, re)
+                # the listing of the last run is reused if the server says that it was not modified since
+                cached_index = self.api_index.load()
+                headers = {"If-None-Match": cached_index["etag"]} if cached_index is not None and cached_index["etag"] else None
+                self.logger.debug("Sending request to Imperva in order to read the current APIs")
+                response = self.client.get(self.client.build_url(), headers=headers, stream=True)
+                if response.status_code == 304:
+                    self.logger.debug("The existing APIs were not modified since the last run - using the cached listing")
+                    response.close()
+                    existing_apis = cached_index["apis"]
+                    existing_api_versions = cached_index["server_versions"]
+                elif response.status_code != 200:
+                    self.log_read_apis_error(response)
+                    return False
+                else:
+                    self.read_api_listing(response, existing_apis, existing_api_versions)
+                    if response.headers.get("ETag"):
+                        self.api_index.save(response.headers["ETag"], existing_apis, existing_api_versions)
+            self.existing_apis = existing_apis
+            self.existing_api_versions = existing_api_versions
+            self.logger.info("Successfully read the existing APIs for site ID %s - Total existing APIs is %d ", self.config.SITE_ID, len(self.existing_apis))
+            return True
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as ex:
+            self.logger.error("Error while trying to read the APIs for site ID %s\nError is '%s'" , self.config.SITE_ID, ex)
             return False
 
 
-    def upload_and_update_apis(self, fetched_api_specs):
+    def read_api_listing(self, response, existing_apis, existing_api_versions, listed_api_ids=None):
+        # returns the number of listed APIs, including the APIs of the other sites which are not kept
+        total_apis = 0
+        try:
+            for host_and_base_path, api_id, server_version, is_site_api in ApiIndex.read_listing(response, self.config.SITE_ID):
+                total_apis += 1
+                if listed_api_ids is not None:
+                    listed_api_ids.add(api_id)
+                if not is_site_api:
+                    continue
+                existing_apis[host_and_base_path] = api_id
+                if server_version is not None:
+                    existing_api_versions[host_and_base_path] = server_version
+        finally:
+            response.close()
+        return total_apis
+
+
+    def log_read_apis_error(self, response):
+        self.logger.error("Failed to read the APIs for site ID %s\nResponse code is %d, %s\nInfo is '%s'", self.config.SITE_ID, response.status_code, response.reason, ResponseBody(response))
+
+
+    def upload_and_update_apis(self, fetched_api_specs, fetched_api_keys):
         self.logger.info("Trying to upload and update the fetched APIs")
-        for host_and_base_path, api_spec in fetched_api_specs.items():
-            # check if the API spec is already uploaded and if so - update it
-            if host_and_base_path in self.existing_apis:
-                self.logger.info("API for '%s' exists in the system - Updating it with the latest fetched version", host_and_base_path)
-                self.update_api(host_and_base_path, api_spec, self.existing_apis[host_and_base_path])
-            else:
-                # in case that the API is not yet protected - upload it
-                self.logger.info("API for '%s' does not exists in the system - uploading it for the first time", host_and_base_path)
-                self.upload_api(host_and_base_path, api_spec)
+        # only the keys of the fetched APIs are kept - the API specs are released once they are pushed, except for the APIs which are
+        # fetched more than once, whose last fetched version with the highest precedence is pushed after all the APIs were fetched
+        held_api_specs = dict()
+        duplicate_keys = set()
+        # with a time budget the new APIs are pushed first, and the changed APIs are pushed only after all the APIs were fetched -
+        # meanwhile the changed API specs are spooled to the disk, so the memory won't grow with the number of changed APIs
+        changed_spool = None
+        if self.sync_deadline is not None:
+            if self.config.STATE_PATH and not os.path.exists(self.config.STATE_PATH):
+                os.makedirs(self.config.STATE_PATH)
+            changed_spool = SpecSpool(tempfile.mkdtemp(prefix="changed-", dir=self.config.STATE_PATH or None), self.logger)
+        # the API specs are pushed while they are fetched, so this phase includes the time that the fetchers take
+        upload_start = time.monotonic()
+        try:
+            with SyncExecutor(self.config.CONCURRENCY, self.client, self.status, self.logger, self.sync_deadline) as sync_executor:
+                for precedence, host_and_base_path, api_spec in fetched_api_specs:
+                    if host_and_base_path not in fetched_api_keys:
+                        fetched_api_keys[host_and_base_path] = precedence
+                        if self.state_store.is_duplicate(host_and_base_path):
+                            # the API was fetched more than once on the last run, so it is held until we know which version wins
+                            held_api_specs[host_and_base_path] = api_spec
+                        else:
+                            self.upload_or_update_api(sync_executor, host_and_base_path, api_spec, changed_spool)
+                        continue
+                    duplicate_keys.add(host_and_base_path)
+                    if precedence >= fetched_api_keys[host_and_base_path]:
+                        # the same API was fetched again with a higher precedence - it is pushed after the first push is done, so the two won't race
+                        self.logger.warning("API for '%s' was fetched more than once - the last fetched version will be used", host_and_base_path)
+                        fetched_api_keys[host_and_base_path] = precedence
+                        held_api_specs[host_and_base_path] = api_spec
+                if changed_spool is not None:
+                    changed_spool.close()
+                    for host_and_base_path, api_spec in SpecSpool.read(changed_spool.path, "changed", self.logger):
+                        self.state_store.plan("updated", host_and_base_path)
+                        sync_executor.submit("updated", host_and_base_path, self.update_api, api_spec, self.existing_apis[host_and_base_path])
+        finally:
+            if changed_spool is not None:
+                changed_spool.close()
+                shutil.rmtree(changed_spool.path, ignore_errors=True)
+        self.state_store.update_duplicates(fetched_api_keys, duplicate_keys)
+        if len(held_api_specs) > 0:
+            # a winning version which was already pushed is skipped like any other API which did not change
+            with SyncExecutor(self.config.CONCURRENCY, self.client, self.status, self.logger, self.sync_deadline) as sync_executor:
+                for host_and_base_path, api_spec in held_api_specs.items():
+                    self.upload_or_update_api(sync_executor, host_and_base_path, api_spec)
+        self.metrics.add_phase("upload_and_update", time.monotonic() - upload_start)
         self.logger.info("Finished to upload and update the fetched APIs")
+        return fetched_api_keys
 
 
-    def delete_apis(self, fetched_api_specs):
-        apis_to_delete = {k: self.existing_apis[k] for k in set(self.existing_apis) - set(fetched_api_specs)}
+    def upload_or_update_api(self, sync_executor, host_and_base_path, api_spec, changed_spool=None):
+        # check if the API spec is already uploaded and if so - update it
+        if host_and_base_path in self.existing_apis:
+            api_spec_id = self.existing_apis[host_and_base_path]
+            server_version = self.existing_api_versions.get(host_and_base_path)
+            # skip the update if the API spec didn't change since it was last pushed to Imperva, and it was not changed at Imperva since
+            if self.state_store.is_unchanged(host_and_base_path, self.spec_transform.get_digest(api_spec), api_spec_id, server_version):
+                self.logger.debug("API for '%s' was not changed since it was last pushed to Imperva - skipping it", host_and_base_path)
+                self.state_store.update(host_and_base_path, self.spec_transform.get_digest(api_spec), api_spec_id, server_version)
+                self.status.update_api_success("unchanged", host_and_base_path)
+            elif not self.is_quarantined(host_and_base_path, api_spec):
+                self.logger.info("API for '%s' exists in the system - Updating it with the latest fetched version", host_and_base_path, extra=self.get_log_fields(host_and_base_path, "updated", api_spec_id))
+                if changed_spool is not None:
+                    changed_spool.add("changed", host_and_base_path, api_spec)
+                else:
+                    self.state_store.plan("updated", host_and_base_path)
+                    sync_executor.submit("updated", host_and_base_path, self.update_api, api_spec, api_spec_id)
+        elif not self.is_quarantined(host_and_base_path, api_spec):
+            # in case that the API is not yet protected - upload it
+            self.logger.info("API for '%s' does not exists in the system - uploading it for the first time", host_and_base_path, extra=self.get_log_fields(host_and_base_path, "added"))
+            self.state_store.plan("added", host_and_base_path)
+            sync_executor.submit("added", host_and_base_path, self.upload_api, api_spec)
+
+
+    def is_quarantined(self, host_and_base_path, api_spec):
+        # an API spec which failed the validation is not pushed again until it changes
+        reason = self.spec_quarantine.get(api_spec.digest)
+        if reason is None:
+            return False
+        self.logger.warning("API for '%s' is quarantined until its API spec changes - %s", host_and_base_path, reason, extra=self.get_log_fields(host_and_base_path, "quarantined"))
+        self.status.update_api_quarantined(host_and_base_path, reason)
+        return True
+
+
+    def validate_api_spec(self, host_and_base_path, api_spec):
+        if self.spec_validator is None:
+            return True
+        with self.metrics.phase("validate"):
+            reason = self.spec_validator.validate(api_spec.data)
+        if reason is None:
+            return True
+        self.logger.error("The API spec for '%s' is invalid - it is quarantined until it changes. The reason is %s", host_and_base_path, reason, extra=self.get_log_fields(host_and_base_path, "quarantined"))
+        self.spec_quarantine.add(api_spec.digest, host_and_base_path, reason)
+        self.status.update_api_quarantined(host_and_base_path, reason)
+        return False
+
+
+    def delete_apis(self, fetched_api_keys):
+        apis_to_delete = {k: v for k, v in self.existing_apis.items() if k not in fetched_api_keys}
         self.logger.info("Found %d APIs which needs to be deleted", len(apis_to_delete))
-        for host_and_base_path, api_id in apis_to_delete.items():
-            self.logger.info("API ID %d for '%s' was not fetched from the repository and therefore will be deleted from Imperva", api_id, host_and_base_path)
-            self.delete_api(host_and_base_path, api_id)
+        with self.metrics.phase("delete"), SyncExecutor(self.config.CONCURRENCY, self.client, self.status, self.logger, self.sync_deadline) as sync_executor:
+            for host_and_base_path, api_id in apis_to_delete.items():
+                self.logger.info("API ID %d for '%s' was not fetched from the repository and therefore will be deleted from Imperva", api_id, host_and_base_path)
+                self.state_store.plan("deleted", host_and_base_path)
+                sync_executor.submit("deleted", host_and_base_path, self.delete_api, api_id)
 
 
     def update_api(self, host_and_base_path, api_spec, api_spec_id):
-        self.logger.debug("Trying to update the API spec %s for '%s'", api_spec_id, host_and_base_path)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Trying to update the API spec %s for '%s'", api_spec_id, host_and_base_path, extra=self.get_log_fields(host_and_base_path, "updated", api_spec_id))
+        if not self.validate_api_spec(host_and_base_path, api_spec):
+            return
         try:
-            response = requests.post(self.config.MANAGEMENT_URL + self.config.SITE_ID + "/" + str(api_spec_id) + ("?api_id=%s&api_key=%s" %(self.config.API_ID, self.config.API_KEY)), files=dict(apiSpecification=json.dumps(api_spec), validateHost=False, specificationViolationAction=self.config.DEFAULT_ACTION), timeout=10)
+            response = self.post_api_spec(self.client.build_url(self.config.SITE_ID, str(api_spec_id)), host_and_base_path, api_spec, "updated")
             if response.status_code != 200:
-                self.logger.error("Failed to update the API spec %s for '%s'.\nResponse code is %d, %s\nInfo is '%s'",api_spec_id, host_and_base_path, response.status_code, response.reason, response.text)
+                self.logger.error("Failed to update the API spec %s for '%s'.\nResponse code is %d, %s\nInfo is '%s'", api_spec_id, host_and_base_path, response.status_code, response.reason,
+                                  ResponseBody(response), extra=self.get_log_fields(host_and_base_path, "updated", api_spec_id, response))
                 self.status.update_api_error("updated", host_and_base_path)
             else:
-                self.logger.debug("Successfully updated the API spec %s for '%s'", api_spec_id, host_and_base_path)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Successfully updated the API spec %s for '%s'", api_spec_id, host_and_base_path, extra=self.get_log_fields(host_and_base_path, "updated", api_spec_id, response))
+                self.state_store.update(host_and_base_path, self.spec_transform.get_digest(api_spec), api_spec_id)
                 self.status.update_api_success("updated", host_and_base_path)
         except requests.exceptions.RequestException as re:
-            self.logger.error("Error while trying to update the API spec %s for '%s', error is '%s'", api_spec_id, host_and_base_path, re)
+            self.logger.error("Error while trying to update the API spec %s for '%s', error is '%s'", api_spec_id, host_and_base_path, re, extra=self.get_log_fields(host_and_base_path, "updated", api_spec_id))
             self.status.update_api_error("updated", host_and_base_path)
 
 
     def upload_api(self, host_and_base_path, api_spec):
-        self.logger.debug("Trying to upload the API spec '%s'", host_and_base_path)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Trying to upload the API spec '%s'", host_and_base_path, extra=self.get_log_fields(host_and_base_path, "added"))
+        if not self.validate_api_spec(host_and_base_path, api_spec):
+            return
         try:
-            response = requests.post(self.config.MANAGEMENT_URL + self.config.SITE_ID + ("?api_id=%s&api_key=%s" %(self.config.API_ID, self.config.API_KEY)), files=dict(apiSpecification=json.dumps(api_spec), validateHost=False, specificationViolationAction=self.config.DEFAULT_ACTION), timeout=10)
+            response = self.post_api_spec(self.client.build_url(self.config.SITE_ID), host_and_base_path, api_spec, "added")
             if response.status_code != 200:
-                self.logger.error("Failed to upload the API spec '%s'.\nResponse code is %d, %s\nInfo is '%s'", host_and_base_path, response.status_code, response.reason, response.text)
+                self.logger.error("Failed to upload the API spec '%s'.\nResponse code is %d, %s\nInfo is '%s'", host_and_base_path, response.status_code, response.reason,
+                                  ResponseBody(response), extra=self.get_log_fields(host_and_base_path, "added", response=response))
                 self.status.update_api_error("added", host_and_base_path)
             else:
-                self.logger.debug("Successfully uploaded the API spec for '%s'", host_and_base_path)
+                api_spec_id = self.get_api_id(response)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("Successfully uploaded the API spec for '%s'", host_and_base_path, extra=self.get_log_fields(host_and_base_path, "added", api_spec_id, response))
+                self.state_store.update(host_and_base_path, self.spec_transform.get_digest(api_spec), api_spec_id)
+                if api_spec_id is not None:
+                    self.existing_apis[host_and_base_path] = api_spec_id
+                else:
+                    # the daemon has to read the existing APIs again, otherwise it would upload this API again on the next cycle
+                    self.existing_apis_read_time = None
                 self.status.update_api_success("added", host_and_base_path)
         except requests.exceptions.RequestException as re:
-            self.logger.error("Error while trying to upload the API spec for '%s', error is '%s'" , host_and_base_path, re)
+            self.logger.error("Error while trying to upload the API spec for '%s', error is '%s'" , host_and_base_path, re, extra=self.get_log_fields(host_and_base_path, "added"))
             self.status.update_api_error("added", host_and_base_path)
 
 
     def delete_api(self, host_and_base_path, api_spec_id):
-        self.logger.debug("Trying to delete the API spec %s for '%s'", api_spec_id, host_and_base_path)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Trying to delete the API spec %s for '%s'", api_spec_id, host_and_base_path, extra=self.get_log_fields(host_and_base_path, "deleted", api_spec_id))
         try:
-            response = requests.delete(self.config.MANAGEMENT_URL + self.config.SITE_ID + "/" +str(api_spec_id) + ("?api_id=%s&api_key=%s" %(self.config.API_ID, self.config.API_KEY)), timeout=10)
+            response = self.client.delete(self.client.build_url(self.config.SITE_ID, str(api_spec_id)))
             if response.status_code != 200:
-                self.logger.error("Failed to delete the API spec %s for '%s'.\nResponse code is %d, %s\nInfo is '%s'", api_spec_id, host_and_base_path, response.status_code, response.reason, response.text)
+                self.logger.error("Failed to delete the API spec %s for '%s'.\nResponse code is %d, %s\nInfo is '%s'", api_spec_id, host_and_base_path, response.status_code, response.reason,
+                                  ResponseBody(response), extra=self.get_log_fields(host_and_base_path, "deleted", api_spec_id, response))
                 self.status.update_api_error("deleted", host_and_base_path)
             else:
-                self.logger.info("Successfully delete the API spec %s for '%s'", api_spec_id, host_and_base_path)
+                self.logger.info("Successfully delete the API spec %s for '%s'", api_spec_id, host_and_base_path, extra=self.get_log_fields(host_and_base_path, "deleted", api_spec_id, response))
+                self.state_store.remove(host_and_base_path)
+                self.existing_apis.pop(host_and_base_path, None)
                 self.status.update_api_success("deleted", host_and_base_path)
         except requests.exceptions.RequestException as re:
-            self.logger.error("Error while trying to delete the API spec %s for '%s', error is '%s'" , api_spec_id, host_and_base_path, re)
+            self.logger.error("Error while trying to delete the API spec %s for '%s', error is '%s'" , api_spec_id, host_and_base_path, re, extra=self.get_log_fields(host_and_base_path, "deleted", api_spec_id))
             self.status.update_api_error("deleted", host_and_base_path)
 
 
+    def get_log_fields(self, host_and_base_path, action, api_spec_id=None, response=None):
+        # the fields of the API in the JSON log records - the text log records don't have them
+        if self.config.LOG_FORMAT != "json":
+            return None
+        return {"site_id": self.config.SITE_ID, "api": host_and_base_path, "action": action, "api_id": api_spec_id, "status_code": response.status_code if response is not None else None}
+
+
+    def post_api_spec(self, url, host_and_base_path, api_spec, action):
+        data = self.transform_api_spec(host_and_base_path, api_spec)
+        self.metrics.observe("payload_bytes", len(data), {"action": action}, Metrics.SIZE_BUCKETS)
+        # an update of an existing API may be sent again, but a retried upload may create the API twice
+        idempotent = action == "updated"
+        files = dict(apiSpecification=data, validateHost=False, specificationViolationAction=self.config.DEFAULT_ACTION)
+        if self.compress_uploads:
+            # the multipart body is built exactly as it is sent uncompressed, and then compressed as a whole
+            multipart_request = requests.Request("POST", url, files=files).prepare()
+            compressed_body = gzip.compress(multipart_request.body)
+            response = self.client.post(url, idempotent=idempotent, data=compressed_body, headers={"Content-Type": multipart_request.headers["Content-Type"], "Content-Encoding": "gzip"})
+            if response.status_code != 415:
+                self.metrics.increment("saved_bytes_total", {"stage": "compress"}, len(multipart_request.body) - len(compressed_body))
+                return response
+            response.close()
+            self.logger.warning("The Imperva management URL does not support compressed requests - sending the API specs uncompressed")
+            self.compress_uploads = False
+        return self.client.post(url, idempotent=idempotent, files=files)
+
+
+    def transform_api_spec(self, host_and_base_path, api_spec):
+        try:
+            data = self.spec_transform.apply(api_spec.data)
+        except (ValueError, TypeError) as ex:
+            self.logger.warning("Failed to transform the API spec for '%s' - sending it as is. Error is %s", host_and_base_path, ex)
+            return api_spec.data
+        self.metrics.increment("saved_bytes_total", {"stage": "transform"}, len(api_spec.data) - len(data))
+        return data
+
+
+    def get_api_id(self, response):
+        # the ID of a newly uploaded API is returned as the response value - if it is missing it is set on the next run
+        try:
+            api_id = response.json().get("value")
+            if isinstance(api_id, int):
+                return api_id
+        except (ValueError, AttributeError):
+            pass
+        return None
+
+
+    def get_status_sample_size(self):
+        # the compact status keeps only a sample of the failed APIs
+        return self.config.STATUS_SAMPLE_SIZE if self.config.STATUS_MODE == "compact" else None
+
+
+    def new_status(self):
+        return Status(self.logger, self.get_status_sample_size())
+
+
+    def report_status(self):
+        # writes the status file and appends the run to the history - returns the reported status for the log
+        sample_size = self.get_status_sample_size()
+        self.status.report_status(self.config.STATUS_PATH, self.config.STATUS_FILE_NAME, sample_size)
+        self.status.append_history(self.config.STATUS_PATH, self.config.HISTORY_FILE_NAME, self.config.HISTORY_MAX_SIZE)
+        return self.status.get_report(sample_size)
+
+
+    def start_metrics(self):
+        # every run has its own metrics, starting with the time it took to load the configuration
+        self.metrics = Metrics()
+        self.metrics.add_phase("config_load", self.config_load_time)
+        self.client.metrics = self.metrics
+
+
+    def report_metrics(self):
+        saved_bytes = self.metrics.get_counter("saved_bytes_total")
+        if saved_bytes > 0:
+            self.logger.info("The transform and the compression of the API specs saved %d bytes", saved_bytes)
+        self.status.set_metrics(self.metrics.to_dict())
+        if self.config.METRICS_PROMETHEUS_FILE:
+            self.metrics.write_prometheus(self.config.METRICS_PROMETHEUS_FILE, self.logger)
+        self.reported_metrics = self.metrics
+
+
+    def run_profiled(self, run, *args):
+        # profiles the main thread of the run, where the fetched API specs are dispatched - the fetchers and the pushes run in their own threads
+        if not self.config.METRICS_PROFILE_PATH:
+            return run(*args)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            return run(*args)
+        finally:
+            profiler.disable()
+            try:
+                if not os.path.exists(self.config.METRICS_PROFILE_PATH):
+                    os.makedirs(self.config.METRICS_PROFILE_PATH)
+                profile_file = os.path.join(self.config.METRICS_PROFILE_PATH, "profile_%s_%s.prof" % (self.config.SITE_ID or "sites", time.strftime("%Y%m%d-%H%M%S")))
+                profiler.dump_stats(profile_file)
+                self.logger.info("The profile of the run was written to %s", profile_file)
+            except Exception as ex:
+                self.logger.error("Failed to write the profile of the run. Error is %s", ex)
+
+
     def set_config(self, path_to_conf_file, conf_json):
         try:
             return Config(path_to_conf_file, conf_json).read()
@@ -173,7 +944,20 @@ class ApiSecurityManager:
     def set_log(self, system_log_path, log_level):
         # set a log file for the API security manager
         logger = logging.getLogger("apiSecurityManager")
-        formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+        # the fetchers log the response bodies with the configured limit as well
+        set_max_body_size(self.config.LOG_MAX_BODY_SIZE)
+        if logger.handlers:
+            # the logger was already set, for example by the parent of a site worker process
+            for handler in logger.handlers:
+                if isinstance(handler, LogQueueHandler):
+                    handler.ensure_listener()
+            self.set_log_level(logger, log_level)
+            return logger
+        if self.config.LOG_FORMAT == "json":
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+        log_handlers = []
         if system_log_path is not None and system_log_path:
             # default log directory for the API security manager
             log_dir = system_log_path
@@ -183,29 +967,58 @@ class ApiSecurityManager:
             # keep logs history for 7 days
             file_handler = logging.handlers.TimedRotatingFileHandler(os.path.join(log_dir, "api_security_manager.log"), when='midnight', backupCount=7)
             file_handler.setFormatter(formatter)
-            logger.addHandler(file_handler)
+            log_handlers.append(file_handler)
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
+        log_handlers.append(console_handler)
+        if self.config.LOG_ASYNC:
+            # the records are formatted and written by a background thread, so the sync never waits for the disk or the console
+            logger.addHandler(LogQueueHandler(log_handlers))
+        else:
+            for log_handler in log_handlers:
+                logger.addHandler(log_handler)
+        self.set_log_level(logger, log_level)
+        return logger
+
+
+    def set_log_level(self, logger, log_level):
         if log_level == "DEBUG":
             logger.setLevel(logging.DEBUG)
         elif log_level == "INFO":
             logger.setLevel(logging.INFO)
         elif log_level == "ERROR":
             logger.setLevel(logging.ERROR)
-        return logger
+
+
+def sync_site(conf_json, site, site_fetchers):
+    # runs in a worker process - a manager of a single site which syncs the spooled API specs
+    site_manager = ApiSecurityManager(None, conf_json, site)
+    site_manager.config.FETCHERS = site_fetchers
+    try:
+        site_status = site_manager.run_profiled(site_manager.protect_apis_with_imperva)
+        # only the counters and a sample of the failed APIs are sent back to the parent process
+        return site["site_id"], site_status, site_manager.status.get_compact_status(site_manager.config.STATUS_SAMPLE_SIZE)
+    except SystemExit:
+        return site["site_id"], 1, None
+    finally:
+        if site_manager.spec_validator is not None:
+            site_manager.spec_validator.close()
+        # the worker process may exit without running the exit handlers, so the log records of the site are written before it returns
+        flush_logs(site_manager.logger)
 
 
 if __name__ == "__main__":
     # Default config path
     path_to_config_file = "/etc/imperva/cloud-api-security/config/config.json"
     config_json = None
+    daemon = False
     try:
         # Read arguments
-        opts, args = getopt.getopt(sys.argv[1:], 'p:c:h', ['path=', 'config=', 'help'])
+        opts, args = getopt.getopt(sys.argv[1:], 'p:c:dh', ['path=', 'config=', 'daemon', 'help'])
     except getopt.GetoptError:
         print("\nError starting API Security Manager. The following arguments should be provided:\n"
                 "'-p' -> path to the configuration JSON file or '-c' -> the configuration JSON itself\n"
+                "'-d' -> optional, keep running and sync the APIs periodically\n"
                 "Or no arguments at all in order to use default paths\n"
                 "Run with -h to get more assistance")
         sys.exit(2)
@@ -214,6 +1027,9 @@ if __name__ == "__main__":
             print ("\nTo run please the following:\n\n"
                    "ApiSecurityManager.py -p <path_to_config_file> \n\n"
                    "OR\n\n"
+                   "ApiSecurityManager.py -p <path_to_config_file> -d \n"
+                   "in order to keep running as a daemon which syncs the APIs periodically\n\n"
+                   "OR\n\n"
                    "ApiSecurityManager.py -c '{'the configuration json'}' with the following structure:\n\n")
             with open('config/config.json', 'r') as handle:
                 parsed = json.load(handle)
@@ -223,11 +1039,19 @@ if __name__ == "__main__":
             path_to_config_file = arg
         elif opt in ('-c', '--config'):
             config_json = arg
+        elif opt in ('-d', '--daemon'):
+            daemon = True
     # Init the ApiSecurityManager
     apiSecurityManager = ApiSecurityManager(path_to_config_file, config_json)
     try:
         # Run the API security manager
-        status = apiSecurityManager.protect_apis_with_imperva()
+        if daemon:
+            # stop gracefully once the current cycle is done
+            signal.signal(signal.SIGTERM, lambda signum, frame: apiSecurityManager.stop())
+            signal.signal(signal.SIGINT, lambda signum, frame: apiSecurityManager.stop())
+            status = apiSecurityManager.run_daemon()
+        else:
+            status = apiSecurityManager.run_profiled(apiSecurityManager.protect_apis_with_imperva)
         sys.exit(status)
     except Exception as e:
         sys.exit("Error running the ApiSecurityManager - %s" % e)
@@ -7,11 +7,15 @@
 ##################################################
 #
 
+import copy
+import hashlib
 import json
 import os
 
 class Config:
 
+    SUPPORTED_ACTIONS = {"ALERT_ONLY", "BLOCK_REQUEST", "BLOCK_USER", "BLOCK_IP", "IGNORE"}
+
     def __init__(self, config_file_path, config_json):
             self.config_json = config_json
             self.config_file_path = config_file_path
@@ -25,31 +29,132 @@ class Config:
             config.LOG_PATH = self.config_json["logging"]["log_path"]
             config.LOG_LEVEL = self.config_json["logging"]["level"]
             config.STATUS_PATH = self.config_json["logging"]["status_path"]
+            # the log records are written as text lines or as JSON objects, by a background thread when async is true
+            config.LOG_FORMAT = self.config_json["logging"].get("format", "text")
+            if config.LOG_FORMAT not in ("text", "json"):
+                raise Exception("the log format should be either text or json")
+            config.LOG_ASYNC = self.config_json["logging"].get("async", False)
+            config.LOG_MAX_BODY_SIZE = self.config_json["logging"].get("max_body_size", 2048)
             config.API_ID = self.config_json["api_id"]
             if not config.API_ID:
                 raise Exception("api_id should not be empty")
             config.API_KEY = self.config_json["api_key"]
             if not config.API_KEY:
                 raise Exception("api_key should not be empty")
-            config.SITE_ID = self.config_json["site_id"]
-            if not config.SITE_ID:
+            # a few sites can be protected in a single run - then the site ID is set per site
+            config.SITES = self.config_json.get("sites")
+            config.SITE_ID = self.config_json.get("site_id")
+            if config.SITES is None and not config.SITE_ID:
                 raise Exception("site_id should not be empty")
+            if config.SITES is not None and (len(config.SITES) == 0 or not all(site.get("site_id") for site in config.SITES)):
+                raise Exception("every site should have a site_id")
+            config.STATUS_FILE_NAME = "status.json"
+            config.HISTORY_FILE_NAME = "history.jsonl"
+            # the compact status has counters and a sample of the failed APIs instead of the lists of all the APIs
+            config.STATUS_MODE = self.config_json["logging"].get("status_mode", "full")
+            if config.STATUS_MODE not in ("full", "compact"):
+                raise Exception("status_mode should be either full or compact")
+            config.STATUS_SAMPLE_SIZE = self.config_json["logging"].get("status_sample_size", 100)
+            config.HISTORY_MAX_SIZE = self.config_json["logging"].get("history_max_size", 10 * 1024 * 1024)
             config.MANAGEMENT_URL = self.config_json["management_url"]
             if not config.MANAGEMENT_URL:
                 raise Exception("management_url should not be empty")
             config.DEFAULT_ACTION = self.config_json["default_action"]
             if not config.DEFAULT_ACTION:
                 raise Exception("default_action should not be empty")
-            supported_actions = {"ALERT_ONLY", "BLOCK_REQUEST", "BLOCK_USER", "BLOCK_IP", "IGNORE"}
-            if config.DEFAULT_ACTION not in supported_actions:
-                raise Exception("default_action should be set to one of the following values - " + str(supported_actions))
+            if config.DEFAULT_ACTION not in Config.SUPPORTED_ACTIONS:
+                raise Exception("default_action should be set to one of the following values - " + str(Config.SUPPORTED_ACTIONS))
+            for site in config.SITES or ():
+                if site.get("default_action", config.DEFAULT_ACTION) not in Config.SUPPORTED_ACTIONS:
+                    raise Exception("the default_action of site %s should be set to one of the following values - %s" % (site["site_id"], Config.SUPPORTED_ACTIONS))
             config.FETCHERS = self.config_json["fetchers"]
+            # optional settings of the sync between the fetched APIs and Imperva
+            sync_config = self.config_json.get("sync", dict())
+            config.STATE_PATH = sync_config.get("state_path")
+            config.CONCURRENCY = sync_config.get("concurrency", 8)
+            if not isinstance(config.CONCURRENCY, int) or config.CONCURRENCY < 1:
+                raise Exception("concurrency should be a positive integer")
+            config.FETCH_TIMEOUT = sync_config.get("fetch_timeout", 600)
+            config.TIME_BUDGET = sync_config.get("time_budget")
+            config.READ_PAGE_SIZE = sync_config.get("read_page_size")
+            config.SITE_WORKERS = sync_config.get("site_workers", os.cpu_count() or 1)
+            # the last successful fetch of every fetcher is kept in the state path, and used when the fetcher fails
+            config.SNAPSHOT_PATH = os.path.join(config.STATE_PATH, "snapshots") if config.STATE_PATH and sync_config.get("snapshots", True) else None
+            config.SNAPSHOT_MAX_AGE = sync_config.get("snapshot_max_age")
+            # optional settings of the daemon mode, where the sync runs in cycles
+            daemon_config = self.config_json.get("daemon", dict())
+            config.DAEMON_INTERVAL = daemon_config.get("interval", 300)
+            if not isinstance(config.DAEMON_INTERVAL, (int, float)) or config.DAEMON_INTERVAL <= 0:
+                raise Exception("the daemon interval should be a positive number")
+            config.DAEMON_FULL_READ_INTERVAL = daemon_config.get("full_read_interval", 3600)
+            # optional settings of the webhook listener which syncs changed APIs between the cycles of the daemon
+            webhook_config = self.config_json.get("webhook", dict())
+            config.WEBHOOK_PORT = webhook_config.get("port")
+            config.WEBHOOK_HOST = webhook_config.get("host", "127.0.0.1")
+            config.WEBHOOK_TOKEN = webhook_config.get("token")
+            config.WEBHOOK_COALESCE_DELAY = webhook_config.get("coalesce_delay", 2)
+            # optional settings of the metrics of every run, in addition to the metrics in the status report
+            metrics_config = self.config_json.get("metrics", dict())
+            config.METRICS_PROMETHEUS_FILE = metrics_config.get("prometheus_file")
+            config.METRICS_PORT = metrics_config.get("port")
+            config.METRICS_HOST = metrics_config.get("host", "127.0.0.1")
+            config.METRICS_PROFILE_PATH = metrics_config.get("profile_path")
+            # optional settings of the transform of the API specs before they are pushed to Imperva
+            config.TRANSFORM = self.config_json.get("transform", dict())
+            config.TRANSFORM_COMPRESS = config.TRANSFORM.get("compress", False)
+            # optional settings of the validation of the API specs before they are pushed to Imperva
+            validation_config = self.config_json.get("validation", dict())
+            config.VALIDATION_ENABLED = validation_config.get("enabled", True)
+            config.VALIDATION_WORKERS = validation_config.get("workers", os.cpu_count() or 1)
+            # optional settings of the client which sends the requests to the Imperva management URL
+            client_config = self.config_json.get("client", dict())
+            config.CLIENT_TIMEOUT = client_config.get("timeout", 10)
+            config.CLIENT_MAX_RETRIES = client_config.get("max_retries", 4)
+            config.CLIENT_BACKOFF_BASE = client_config.get("backoff_base", 0.5)
+            config.CLIENT_BACKOFF_MAX = client_config.get("backoff_max", 30)
+            config.CLIENT_INITIAL_RPS = client_config.get("initial_rps", 10)
+            config.CLIENT_MIN_RPS = client_config.get("min_rps", 1)
+            config.CLIENT_MAX_RPS = client_config.get("max_rps", 100)
+            if not 0 < config.CLIENT_MIN_RPS <= config.CLIENT_INITIAL_RPS <= config.CLIENT_MAX_RPS:
+                raise Exception("the client rates should be positive and min_rps <= initial_rps <= max_rps")
+            config.CLIENT_CIRCUIT_BREAKER_THRESHOLD = client_config.get("circuit_breaker_threshold", 10)
+            config.CLIENT_CIRCUIT_BREAKER_RESET = client_config.get("circuit_breaker_reset", 60)
             return config
         except Exception as ex:
             print("ERROR - Exception while reading the ApiSecurityManager configuration: %s" % ex)
             raise Exception()
 
 
+    def for_site(self, site):
+        # the configuration of a single site out of the sites of a multi-site configuration
+        site_config = copy.copy(self)
+        site_config.SITES = None
+        site_config.SITE_ID = site["site_id"]
+        site_config.DEFAULT_ACTION = site.get("default_action", self.DEFAULT_ACTION)
+        # the sites are synced in parallel processes, so they share the validation processes instead of each starting all of them
+        site_config.VALIDATION_WORKERS = max(1, self.VALIDATION_WORKERS // min(self.SITE_WORKERS, len(self.SITES)))
+        site_config.STATUS_FILE_NAME = "status_%s.json" % site["site_id"]
+        site_config.HISTORY_FILE_NAME = "history_%s.jsonl" % site["site_id"]
+        return site_config
+
+
+    @staticmethod
+    def get_site_fetcher_ids(site, fetchers):
+        # a site uses the fetchers which are listed by their names, or all the active fetchers
+        if site.get("fetchers") is not None:
+            return set(site["fetchers"])
+        return set(Config.get_fetcher_id(fetcher) for fetcher in fetchers if fetcher["active"])
+
+
+    @staticmethod
+    def get_fetcher_id(fetcher):
+        # a fetcher is identified by its name, or by its type and settings when it has no name
+        if fetcher.get("name"):
+            return fetcher["name"]
+        settings_digest = hashlib.sha256(json.dumps(fetcher.get("settings"), sort_keys=True).encode("utf-8")).hexdigest()
+        return "%s-%s" % (fetcher["type"], settings_digest[:12])
+
+
     def read_conf_from_file(self):
         if os.path.isfile(self.config_file_path):
             try:
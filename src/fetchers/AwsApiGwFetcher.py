@@ -7,41 +7,175 @@
 ##################################################
 #
 
-import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 import boto3
+from botocore.config import Config
+
+from fetchers.FetchError import FetchError
+from utils.ApiSpec import ApiSpec
+from utils.FileCache import FileCache
 
 
 class AwsApiGwFetcher:
 
+    # the clients are kept between the runs of the daemon, so their connections and assumed roles are reused
+    clients = dict()
+    clients_lock = threading.Lock()
+
     @staticmethod
-    def fetch(settings, logger):
+    def fetch(settings, logger, status):
         access_key_id = settings["aws_access_key_id"]
         secret_access_key = settings["aws_secret_access_key"]
-        region = settings["aws_region"]
+        # a single fetcher can scan a few regions and a few accounts by assuming a role in each one of them
+        regions = settings.get("aws_regions") or [settings.get("aws_region")]
+        role_arns = settings.get("aws_role_arns") or [None]
         logger.debug("Trying to fetch API specs from AWS API GW")
         if access_key_id is None or not access_key_id:
-            logger.error("Can't fetch APIs from AWS API GW since we are missing the aws_access_key_id")
-            return None
+            raise FetchError("Can't fetch APIs from AWS API GW since we are missing the aws_access_key_id")
         if secret_access_key is None or not secret_access_key:
-            logger.error("Can't fetch APIs from AWS API GW since we are missing the aws_secret_access_key")
-            return None
-        if region is None or not region:
-            logger.error("Can't fetch APIs from AWS API GW since we are missing the AWS region")
+            raise FetchError("Can't fetch APIs from AWS API GW since we are missing the aws_secret_access_key")
+        if not all(regions):
+            raise FetchError("Can't fetch APIs from AWS API GW since we are missing the AWS region")
+        max_workers = settings.get("max_workers", 8)
+        # caps the AWS calls of all the regions together, so a scan of many regions won't get us throttled by AWS
+        max_in_flight = settings.get("max_in_flight", max_workers)
+        in_flight = threading.BoundedSemaphore(max_in_flight)
+        export_cache = FileCache(settings.get("export_cache_path"), logger)
+        target_pairs = [(role_arn, region) for role_arn in role_arns for region in regions]
+        targets = [AwsApiGwFetcher.get_target_name(role_arn, region) for role_arn, region in target_pairs]
+        # first the stages of all the regions are listed at the same time
+        with ThreadPoolExecutor(max_workers = len(targets)) as executor:
+            listings = list(executor.map(lambda target: AwsApiGwFetcher.list_region(access_key_id, secret_access_key, target[0], target[1], max_workers, in_flight, logger), target_pairs))
+        failed_targets = set()
+        exports = []
+        for target_name, listing in zip(targets, listings):
+            if listing is None:
+                failed_targets.add(target_name)
+            else:
+                aws_client, stages = listing
+                exports.extend((target_name, aws_client, api_id, stage_name, deployment_id) for api_id, stage_name, deployment_id in stages)
+        # then the stages of all the regions are exported by a shared pool, in chunks so the API specs are handed over while they are exported
+        total_fetched_apis = 0
+        chunk_size = max_in_flight * 4
+        with ThreadPoolExecutor(max_workers = max_in_flight) as executor:
+            for chunk_start in range(0, len(exports), chunk_size):
+                chunk = exports[chunk_start:chunk_start + chunk_size]
+                api_specs = executor.map(lambda export: AwsApiGwFetcher.export_stage(export_cache, export[0], export[1], export[2], export[3], export[4], in_flight, logger), chunk)
+                for export, api_spec in zip(chunk, api_specs):
+                    if api_spec is None:
+                        failed_targets.add(export[0])
+                    else:
+                        total_fetched_apis += 1
+                        yield api_spec.host_and_base_path, api_spec
+        for target_name in targets:
+            if target_name in failed_targets:
+                status.update_fetcher_region_error(target_name)
+            else:
+                status.update_fetcher_region_success(target_name)
+        if len(failed_targets) == len(targets):
+            raise FetchError("Failed to fetch API specs from all the AWS API GW regions")
+        if len(failed_targets) > 0:
+            # the fetch is incomplete, so the APIs of the failed regions must not be deleted - they are taken from the snapshot of the fetcher, if there is one
+            raise FetchError("Failed to fetch API specs from the AWS API GW regions %s - fetched %d API specs from the other regions" % (", ".join(sorted(failed_targets)), total_fetched_apis))
+        # keep only the exports of the current deployments in the cache
+        export_cache.retain(AwsApiGwFetcher.get_export_cache_key(export[0], export[2], export[3], export[4]) for export in exports if export[4] is not None)
+        logger.info("Successfully fetched %d API specs from %d AWS API GW regions", total_fetched_apis, len(targets) - len(failed_targets))
+
+
+    @staticmethod
+    def list_region(access_key_id, secret_access_key, role_arn, region, max_workers, in_flight, logger):
+        target_name = AwsApiGwFetcher.get_target_name(role_arn, region)
+        try:
+            # a single client is used for all the calls of the region - boto3 clients are thread safe
+            aws_client = AwsApiGwFetcher.create_client(access_key_id, secret_access_key, role_arn, region, max_workers, in_flight)
+            # the APIs are listed page by page, otherwise the APIs beyond the first page would be deleted from Imperva
+            api_ids = []
+            pages = iter(aws_client.get_paginator('get_rest_apis').paginate())
+            while True:
+                with in_flight:
+                    page = next(pages, None)
+                if page is None:
+                    break
+                api_ids.extend(api["id"] for api in page["items"])
+            logger.debug("Found %d APIs in AWS API GW %s, fetching their stages", len(api_ids), target_name)
+            with ThreadPoolExecutor(max_workers = max_workers) as executor:
+                api_stages = executor.map(lambda api_id: AwsApiGwFetcher.get_stages(aws_client, api_id, in_flight), api_ids)
+                stages = [(api_id, stage["stageName"], stage.get("deploymentId")) for api_id, stages in zip(api_ids, api_stages) for stage in stages]
+            return aws_client, stages
+        except Exception as ex:
+            logger.error("Error while trying to fetch API specs from AWS API GW %s - error is %s", target_name, ex)
             return None
+
+
+    @staticmethod
+    def create_client(access_key_id, secret_access_key, role_arn, region, max_workers, in_flight):
+        client_key = (access_key_id, secret_access_key, role_arn, region, max_workers)
+        with AwsApiGwFetcher.clients_lock:
+            cached_client = AwsApiGwFetcher.clients.get(client_key)
+        # a client of an assumed role is created again a few minutes before its credentials expire
+        if cached_client is not None and (cached_client[1] is None or datetime.now(timezone.utc) < cached_client[1] - timedelta(minutes=5)):
+            return cached_client[0]
+        aws_client, expiration = AwsApiGwFetcher.create_role_client(access_key_id, secret_access_key, role_arn, region, max_workers, in_flight)
+        with AwsApiGwFetcher.clients_lock:
+            AwsApiGwFetcher.clients[client_key] = (aws_client, expiration)
+        return aws_client
+
+
+    @staticmethod
+    def create_role_client(access_key_id, secret_access_key, role_arn, region, max_workers, in_flight):
+        client_config = Config(max_pool_connections = max_workers)
+        if role_arn is None:
+            return boto3.client('apigateway', aws_access_key_id = access_key_id, aws_secret_access_key = secret_access_key, region_name = region, config = client_config), None
+        sts_client = boto3.client('sts', aws_access_key_id = access_key_id, aws_secret_access_key = secret_access_key, region_name = region)
+        with in_flight:
+            credentials = sts_client.assume_role(RoleArn = role_arn, RoleSessionName = "imperva-api-security")["Credentials"]
+        return boto3.client('apigateway', aws_access_key_id = credentials["AccessKeyId"], aws_secret_access_key = credentials["SecretAccessKey"], aws_session_token = credentials["SessionToken"], region_name = region, config = client_config), credentials["Expiration"]
+
+
+    @staticmethod
+    def get_target_name(role_arn, region):
+        if role_arn is None:
+            return region
+        # the account ID is the fifth field of the role ARN - arn:aws:iam::<account_id>:role/<role_name>
+        return "%s/%s" % (role_arn.split(":")[4], region)
+
+
+    @staticmethod
+    def get_stages(aws_client, api_id, in_flight):
+        with in_flight:
+            return aws_client.get_stages(restApiId = api_id)["item"]
+
+
+    @staticmethod
+    def get_export_cache_key(target_name, rest_api_id, stage_name, deployment_id):
+        return "%s/%s/%s/%s" % (target_name, rest_api_id, stage_name, deployment_id)
+
+
+    @staticmethod
+    def export_stage(export_cache, target_name, aws_client, rest_api_id, stage_name, deployment_id, in_flight, logger):
         try:
-            aws_client = boto3.client('apigateway', aws_access_key_id = access_key_id, aws_secret_access_key = secret_access_key, region_name = region)
-            apis = aws_client.get_rest_apis()
-            fetched_apis = dict()
-            for api in apis["items"]:
-                stages = aws_client.get_stages(restApiId = api["id"])
-                for stage in stages["item"]:
-                    swagger = aws_client.get_export(restApiId=api["id"], stageName=stage["stageName"], exportType="swagger", parameters={'extensions': 'integrations'}, accepts="application/json")
-                    api_spec = json.loads((swagger["body"].read()))
-                    fetched_apis[api_spec["host"] + api_spec["basePath"]] = api_spec
-                    logger.debug("Fetched swagger for API %s for stage %s", api["id"], stage["stageName"])
-            logger.info("Successfully fetched %d API specs from AWS API GW", len(fetched_apis))
-            return fetched_apis
+            return AwsApiGwFetcher.get_api_spec(export_cache, target_name, aws_client, rest_api_id, stage_name, deployment_id, in_flight, logger)
         except Exception as ex:
-            logger.error("Error while trying to fetch API specs from AWS API GW - error is %s", ex)
+            logger.error("Error while trying to export API %s for stage %s from AWS API GW %s - error is %s", rest_api_id, stage_name, target_name, ex)
             return None
+
+
+    @staticmethod
+    def get_api_spec(export_cache, target_name, aws_client, rest_api_id, stage_name, deployment_id, in_flight, logger):
+        # the export of a stage only changes when a new deployment is made to it, so it is cached by the deployment ID
+        cache_key = AwsApiGwFetcher.get_export_cache_key(target_name, rest_api_id, stage_name, deployment_id)
+        swagger_body = export_cache.get(cache_key) if deployment_id is not None else None
+        if swagger_body is not None:
+            logger.debug("Using the cached swagger for API %s for stage %s of deployment %s", rest_api_id, stage_name, deployment_id)
+        else:
+            with in_flight:
+                swagger = aws_client.get_export(restApiId=rest_api_id, stageName=stage_name, exportType="swagger", parameters={'extensions': 'integrations'}, accepts="application/json")
+                swagger_body = swagger["body"].read()
+            if deployment_id is not None:
+                export_cache.put(cache_key, swagger_body)
+            logger.debug("Fetched swagger for API %s for stage %s", rest_api_id, stage_name)
+        # the exported bytes are uploaded as is - only the host and base path are read from them
+        return ApiSpec.from_json(swagger_body)
@@ -8,60 +8,143 @@
 #
 
 import codecs
+import hashlib
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from fetchers.FetchError import FetchError
+from utils.ApiSpec import ApiSpec
+from utils.FileCache import FileCache
+from utils.LogPipeline import ResponseBody
 
 
 class AzureFetcher:
 
+    # the sessions are kept between the runs of the daemon, so the connections to Azure stay alive
+    sessions = dict()
+    sessions_lock = threading.Lock()
+
     @staticmethod
-    def fetch(settings, logger):
+    def fetch(settings, logger, status):
         subscription_id=settings["subscription_id"]
         resource_group_name=settings["resource_group_name"]
         service_name=settings["service_name"]
         access_token=settings["access_token"]
         logger.debug("Trying to fetch API specs from Azure")
         if subscription_id is None or not subscription_id:
-            logger.error("Can't fetch APIs from Azure since we are missing the subscription ID")
-            return None
+            raise FetchError("Can't fetch APIs from Azure since we are missing the subscription ID")
         if resource_group_name is None or not resource_group_name:
-            logger.error("Can't fetch APIs from Azure since we are missing the resource group name")
-            return None
+            raise FetchError("Can't fetch APIs from Azure since we are missing the resource group name")
         if service_name is None or not service_name:
-            logger.error("Can't fetch APIs from Azure since we are missing the service name")
-            return None
+            raise FetchError("Can't fetch APIs from Azure since we are missing the service name")
         if access_token is None or not access_token:
-            logger.error("Can't fetch APIs from Azure since we are missing the access token")
-            return None
+            raise FetchError("Can't fetch APIs from Azure since we are missing the access token")
+        max_workers = settings.get("max_workers", 8)
+        cache_max_age = settings.get("cache_max_age", 86400)
         try:
-            azure_base_url = "https://%s.management.azure-api.net/subscriptions/%s/resourceGroups/%s/providers/Microsoft.ApiManagement/service/%s/apis?api-version=2018-06-01-preview" % (service_name, subscription_id, resource_group_name, service_name)
-            all_apis_response = requests.get(azure_base_url, headers={'Authorization': access_token}, timeout=10)
-            if all_apis_response.status_code != 200:
-                logger.error("Failed to fetch API specs from Azure. Response code is %d, %s\nInfo is %s", all_apis_response.status_code, all_apis_response.reason, all_apis_response.text )
-                return None
-            else:
-                fetched_apis = dict()
-                apis = all_apis_response.json()["value"]
-                logger.debug("Found %d APIs in Azure, fetching their details", len(apis))
-                for api in apis:
-                    logger.debug("Trying to fetch API %s from Azure", api["id"])
-                    api_url = "https://%s.management.azure-api.net/subscriptions/%s/resourceGroups/%s/providers/Microsoft.ApiManagement/service/%s/apis/%s?format=swagger-link&export=true&api-version=2018-06-01-preview" % (service_name, subscription_id, resource_group_name, service_name, api["name"])
-                    api_response = requests.get(api_url, headers={'Authorization': access_token}, timeout=10)
-                    if api_response.status_code != 200:
-                        logger.error("Failed to fetch API %s from Azure. Response code is %d, %s\nInfo is %s" ,api["id"], api_response.status_code, api_response.reason, api_response.text)
-                    else:
-                        api_link = json.loads(codecs.decode(api_response.content, 'utf-8-sig'))["link"]
-                        logger.debug("Fetching swagger for API %s from Azure - the URL is %s", api["id"], api_link)
-                        swagger_response = requests.get(api_link, timeout=10)
-                        if swagger_response.status_code != 200:
-                            logger.error("Failed to fetch API %s from Azure. Response code is %d, %s\nInfo is %s", api_link, swagger_response.status_code, swagger_response.reason, swagger_response.text)
-                        else:
-                            api_spec = swagger_response.json()
-                            fetched_apis[api_spec["host"] + api_spec["basePath"]] = api_spec
-                            logger.debug("Successfully fetched the API spec for %s from Azure", api["id"])
-                logger.info("Successfully fetched %d API specs from Azure", len(fetched_apis))
-                return fetched_apis
+            spec_cache = FileCache(settings.get("cache_path"), logger)
+            session = AzureFetcher.get_session(access_token, max_workers)
+            azure_service_url = "https://%s.management.azure-api.net/subscriptions/%s/resourceGroups/%s/providers/Microsoft.ApiManagement/service/%s" % (service_name, subscription_id, resource_group_name, service_name)
+            # the APIs are listed page by page by following the nextLink of every page
+            apis = []
+            next_link = azure_service_url + "/apis?api-version=2018-06-01-preview"
+            while next_link:
+                all_apis_response = session.get(next_link, timeout=10)
+                if all_apis_response.status_code != 200:
+                    raise FetchError("Failed to fetch API specs from Azure. Response code is %d, %s\nInfo is %s" % (all_apis_response.status_code, all_apis_response.reason, ResponseBody(all_apis_response)))
+                apis_page = all_apis_response.json()
+                apis.extend(apis_page["value"])
+                next_link = apis_page.get("nextLink")
+            logger.debug("Found %d APIs in Azure, fetching their details", len(apis))
+            total_fetched_apis = 0
+            # the APIs which failed to download - the rest are still handed over, but the fetch fails so none of the APIs is deleted
+            failed_apis = []
+            # the APIs are downloaded in chunks, so the downloaded API specs are handed over before all the APIs are downloaded
+            chunk_size = max_workers * 4
+            with ThreadPoolExecutor(max_workers = max_workers) as executor:
+                for chunk_start in range(0, len(apis), chunk_size):
+                    chunk = apis[chunk_start:chunk_start + chunk_size]
+                    futures = [executor.submit(AzureFetcher.fetch_api, session, azure_service_url, api, spec_cache, cache_max_age, logger) for api in chunk]
+                    for api, future in zip(chunk, futures):
+                        try:
+                            api_spec = future.result()
+                        except (FetchError, requests.exceptions.RequestException) as ex:
+                            logger.error("Failed to fetch API %s from Azure - %s", api["id"], ex, extra={"fetcher": "AzureFetcher"})
+                            failed_apis.append(api["id"])
+                            continue
+                        if api_spec is not None:
+                            total_fetched_apis += 1
+                            yield api_spec.host_and_base_path, api_spec
+            spec_cache.retain(key for api in apis for key in AzureFetcher.get_cache_keys(api))
+            if len(failed_apis) > 0:
+                raise FetchError("Failed to fetch %d of the APIs from Azure - fetched %d API specs from the other APIs" % (len(failed_apis), total_fetched_apis))
+            logger.info("Successfully fetched %d API specs from Azure", total_fetched_apis)
         except requests.exceptions.RequestException as re:
-            logger.error("Error while trying to fetch API specs from Azure - error is %s", re)
+            raise FetchError("Error while trying to fetch API specs from Azure - error is %s" % re)
+
+
+    @staticmethod
+    def get_session(access_token, max_workers):
+        with AzureFetcher.sessions_lock:
+            session = AzureFetcher.sessions.get((access_token, max_workers))
+            if session is None:
+                # a single session for all the calls, so the connections to Azure are kept alive and reused
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max_workers)
+                session.mount("https://", adapter)
+                session.headers.update({'Authorization': access_token})
+                AzureFetcher.sessions[(access_token, max_workers)] = session
+            return session
+
+
+    @staticmethod
+    def get_cache_keys(api):
+        return "%s/meta" % api["id"], "%s/spec" % api["id"]
+
+
+    @staticmethod
+    def fetch_api(session, azure_service_url, api, spec_cache, cache_max_age, logger):
+        meta_key, spec_key = AzureFetcher.get_cache_keys(api)
+        # the API properties include its revision, so a new revision or a change to the API settings changes the fingerprint
+        fingerprint = hashlib.sha256(json.dumps(api["properties"], sort_keys=True).encode("utf-8")).hexdigest()
+        cached_meta = spec_cache.get(meta_key)
+        cached_meta = json.loads(cached_meta.decode("utf-8")) if cached_meta is not None else None
+        cached_spec = spec_cache.get(spec_key)
+        if cached_meta is not None and cached_spec is not None and cached_meta["fingerprint"] == fingerprint and time.time() - cached_meta["time"] < cache_max_age:
+            logger.debug("API %s was not changed in Azure - using the cached API spec", api["id"])
+            return ApiSpec.from_json(cached_spec, cached_meta.get("key"))
+        logger.debug("Trying to fetch API %s from Azure", api["id"])
+        api_url = "%s/apis/%s?format=swagger-link&export=true&api-version=2018-06-01-preview" % (azure_service_url, api["name"])
+        api_response = session.get(api_url, timeout=10)
+        if api_response.status_code != 200:
+            raise FetchError("Response code is %d, %s\nInfo is %s" % (api_response.status_code, api_response.reason, ResponseBody(api_response)))
+        api_link = json.loads(codecs.decode(api_response.content, 'utf-8-sig'))["link"]
+        logger.debug("Fetching swagger for API %s from Azure - the URL is %s", api["id"], api_link)
+        # the swagger link is a signed blob URL so it is downloaded without the Azure authorization header
+        headers = {'Authorization': None}
+        if cached_meta is not None and cached_spec is not None and cached_meta.get("etag"):
+            headers['If-None-Match'] = cached_meta["etag"]
+        swagger_response = session.get(api_link, headers=headers, timeout=10)
+        if swagger_response.status_code == 304:
+            logger.debug("The swagger for API %s was not changed in Azure - using the cached API spec", api["id"])
+            swagger_body = cached_spec
+        elif swagger_response.status_code != 200:
+            raise FetchError("Failed to download the swagger from %s. Response code is %d, %s\nInfo is %s" % (api_link, swagger_response.status_code, swagger_response.reason, ResponseBody(swagger_response)))
+        else:
+            swagger_body = swagger_response.content
+            spec_cache.put(spec_key, swagger_body)
+        # the downloaded bytes are uploaded as is - only the host and base path are read from them
+        try:
+            api_spec = ApiSpec.from_json(swagger_body)
+        except (ValueError, KeyError, TypeError) as ex:
+            logger.error("Failed to read the swagger of API %s from Azure - %s", api["id"], ex)
             return None
+        etag = swagger_response.headers.get("ETag") or (cached_meta or dict()).get("etag")
+        spec_cache.put(meta_key, json.dumps({"fingerprint": fingerprint, "etag": etag, "time": time.time(), "key": api_spec.host_and_base_path}).encode("utf-8"))
+        logger.debug("Successfully fetched the API spec for %s from Azure", api["id"])
+        return api_spec
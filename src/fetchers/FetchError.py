@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+
+class FetchError(Exception):
+    pass
@@ -7,49 +7,140 @@
 ##################################################
 #
 
-import json
+import codecs
+import fnmatch
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import yaml
 
+from fetchers.FetchError import FetchError
+from utils.ApiSpec import ApiSpec
+from utils.AtomicFile import load_json, save_json
+from utils.FileCache import FileCache
+
+# the C based YAML loader is much faster - we fall back to the pure python one when libyaml is not installed
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def parse_api_spec_file(file_path):
+    # runs in a worker process, so it returns the parsing error instead of logging it
+    try:
+        with open(file_path, 'rb') as api_spec_file:
+            file_content = api_spec_file.read()
+        digest = hashlib.sha256(file_content).hexdigest()
+        # since swagger can be either JSON or YAML, we detect the format by the file extension or by its first character
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension == ".json" or (extension not in (".yaml", ".yml") and file_content.lstrip(codecs.BOM_UTF8 + b" \t\r\n")[:1] in (b"{", b"[")):
+            try:
+                # JSON files are uploaded as is - only the host and base path are read from them
+                return digest, ApiSpec.from_json(file_content), None
+            except ValueError as ex:
+                if extension == ".json":
+                    return digest, None, "couldn't parse it as JSON - %s" % ex
+        api_spec = yaml.load(file_content.decode("utf-8-sig"), Loader=YamlLoader)
+        if not isinstance(api_spec, dict):
+            return digest, None, "it is not an API spec"
+        return digest, ApiSpec.from_dict(api_spec), None
+    except Exception as ex:
+        return None, None, "couldn't parse it as JSON or as YAML - %s" % ex
+
 
 class FileSystemFetcher:
 
+    INDEX_VERSION = 2
+
     @staticmethod
-    def fetch(settings, logger):
+    def fetch(settings, logger, status):
         path = settings["filesystem_path"]
         logger.debug("Trying to fetch API specs from a local path '%s'", path)
         if path is None or not path:
-            logger.error("Can't fetch APIs from local path since the path is missing or empty")
-            return None
+            raise FetchError("Can't fetch APIs from local path since the path is missing or empty")
         if not os.path.exists(path):
-            logger.error("Can't read APIs from local path since the path '%s' does not exists", path)
-            return None
-        else:
-            fetched_apis = dict()
-            for file_name in os.listdir(path):
-                file_path = os.path.join(path, file_name)
-                valid_json = False
-                valid_yaml = False
-                logger.debug("Found the '%s' file - trying to open and parse it", file_path)
-                with open(file_path) as api_spec_file:
-                    file_content = api_spec_file.read()
-                    # since swagger can be either JSON or YAML, we need to support both use cases
-                    try:
-                        api_spec = json.loads(file_content)
-                        valid_json = True
-                    except Exception as ex:
-                        logger.debug("couldn't parse '%s' as JSON", file_path)
-                    if not valid_json:
-                        try:
-                            api_spec = yaml.safe_load(file_content)
-                            valid_yaml = True
-                        except Exception as ex:
-                            logger.debug("couldn't parse '%s' as YAML", file_path)
-                    if not valid_json and not valid_yaml:
-                        logger.error("Failed to parse %s as JSON and as YAML", file_path)
+            raise FetchError("Can't read APIs from local path since the path '%s' does not exists" % path)
+        index_path = settings.get("index_path")
+        file_index = FileSystemFetcher.load_index(index_path, logger)
+        spec_cache = FileCache(os.path.join(index_path, "specs") if index_path else None, logger)
+        new_file_index = dict()
+        total_fetched_apis = 0
+        changed_files = []
+        for file_path in FileSystemFetcher.list_files(path, settings.get("exclude", ())):
+            file_stat = os.stat(file_path)
+            indexed_file = file_index.get(file_path)
+            if indexed_file is not None and indexed_file["mtime"] == file_stat.st_mtime_ns and indexed_file["size"] == file_stat.st_size:
+                cached_spec = spec_cache.get(indexed_file["digest"])
+                if cached_spec is not None:
+                    logger.debug("The '%s' file was not changed - using its cached API spec", file_path)
+                    new_file_index[file_path] = indexed_file
+                    total_fetched_apis += 1
+                    yield indexed_file["key"], ApiSpec(cached_spec, indexed_file["key"])
+                    continue
+            changed_files.append((file_path, file_stat))
+        logger.debug("Found %d new or changed files - trying to open and parse them", len(changed_files))
+        parse_workers = settings.get("parse_workers", os.cpu_count() or 1)
+        # the files are parsed in chunks, so the parsed API specs are handed over before all the files are parsed
+        chunk_size = parse_workers * 16
+        executor = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers > 1 and len(changed_files) > 1 else None
+        try:
+            for chunk_start in range(0, len(changed_files), chunk_size):
+                chunk = changed_files[chunk_start:chunk_start + chunk_size]
+                if executor is not None:
+                    # parsing is CPU bound, so the files are parsed in a few processes
+                    parsed_files = executor.map(parse_api_spec_file, [file_path for file_path, file_stat in chunk], chunksize=16)
+                else:
+                    parsed_files = (parse_api_spec_file(file_path) for file_path, file_stat in chunk)
+                for (file_path, file_stat), (digest, api_spec, error) in zip(chunk, parsed_files):
+                    if error is not None:
+                        logger.error("Failed to parse %s - %s", file_path, error)
                     else:
                         logger.debug("Successfully opened and parsed the '%s' file", file_path)
-                        fetched_apis[api_spec["host"] + api_spec["basePath"]] = api_spec
-            logger.info("Fetched %d APIs from the filesystem", len(fetched_apis))
-            return fetched_apis
+                        if spec_cache.enabled():
+                            spec_cache.put(digest, api_spec.data)
+                            new_file_index[file_path] = {"mtime": file_stat.st_mtime_ns, "size": file_stat.st_size, "digest": digest, "key": api_spec.host_and_base_path}
+                        total_fetched_apis += 1
+                        yield api_spec.host_and_base_path, api_spec
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+        FileSystemFetcher.save_index(index_path, new_file_index, logger)
+        spec_cache.retain(indexed_file["digest"] for indexed_file in new_file_index.values())
+        logger.info("Fetched %d APIs from the filesystem", total_fetched_apis)
+
+
+    @staticmethod
+    def list_files(path, exclude=()):
+        # the files are sorted, so when a few files have the same API the same file always wins
+        file_paths = []
+        for dir_path, dir_names, file_names in os.walk(path):
+            # hidden directories, such as .git, and the excluded directories are not scanned
+            dir_names[:] = [dir_name for dir_name in dir_names if not dir_name.startswith(".") and not FileSystemFetcher.is_excluded(dir_name, exclude)]
+            for file_name in file_names:
+                if not FileSystemFetcher.is_excluded(file_name, exclude):
+                    file_paths.append(os.path.join(dir_path, file_name))
+        return sorted(file_paths)
+
+
+    @staticmethod
+    def is_excluded(name, exclude):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in exclude)
+
+
+    @staticmethod
+    def load_index(index_path, logger):
+        if index_path is None or not index_path:
+            return dict()
+        # all the files are parsed if the index can't be loaded
+        file_index = load_json(os.path.join(index_path, "index.json"), FileSystemFetcher.INDEX_VERSION, "file index", logger)
+        return file_index["files"] if file_index is not None else dict()
+
+
+    @staticmethod
+    def save_index(index_path, file_index, logger):
+        if index_path is None or not index_path:
+            return
+        index_file = os.path.join(index_path, "index.json")
+        try:
+            save_json(index_file, {"version": FileSystemFetcher.INDEX_VERSION, "files": file_index})
+        except Exception as ex:
+            logger.error("Failed to save the file index to '%s'. Error is %s", index_file, ex)
@@ -8,38 +8,119 @@
 #
 
 import json
+import threading
 
 import requests
 
+from fetchers.FetchError import FetchError
+from utils.ApiSpec import ApiSpec
+from utils.FileCache import FileCache
+from utils.LogPipeline import ResponseBody
+
+try:
+    # ijson is optional - with it the ActiveDocs are parsed one by one while they are downloaded
+    import ijson
+except ImportError:
+    ijson = None
+
 
 class ThreeScaleFetcher:
 
+    # the sessions are kept between the runs of the daemon, so the connections to 3Scale stay alive
+    sessions = dict()
+    sessions_lock = threading.Lock()
+
     @staticmethod
-    def fetch(settings, logger):
+    def fetch(settings, logger, status):
         url = settings["three_scale_url"]
         access_token = settings["three_scale_access_token"]
         logger.debug("Trying to fetch API specs from 3Scale")
         if url is None or not url:
-            logger.error("Can't fetch APIs from 3Scale since we are missing the URL")
-            return None
+            raise FetchError("Can't fetch APIs from 3Scale since we are missing the URL")
         if access_token is None or not access_token:
-            logger.error("Can't fetch APIs from 3Scale since we are missing the Access Token")
-            return None
-        params = { 'access_token': access_token }
+            raise FetchError("Can't fetch APIs from 3Scale since we are missing the Access Token")
+        per_page = settings.get("per_page", 100)
         try:
-            response = requests.get("https://%s/admin/api/active_docs.json" % url, params, timeout=10)
-            if response.status_code != 200:
-                logger.error("Failed to fetch API specs from 3Scale. Response code is %d, %s\nInfo is %s", response.status_code, response.reason, response.text )
-                return None
-            else:
-                fetched_apis = dict()
-                apis = response.json()["api_docs"]
-                logger.info("Successfully fetched %d API specs from 3Scale", len(apis))
-                for api in apis:
-                    api_spec = json.loads(api["api_doc"]["body"].replace("\r","").replace("\n","").strip())
-                    fetched_apis[api_spec["host"] + api_spec["basePath"]] = api_spec
-                logger.info("Fetched %d APIs from the 3Scale", len(fetched_apis))
-                return fetched_apis
+            spec_cache = FileCache(settings.get("cache_path"), logger)
+            session = ThreeScaleFetcher.get_session(url)
+            fetched_apis = set()
+            seen_doc_ids = set()
+            total_docs = 0
+            page = 1
+            while True:
+                params = { 'access_token': access_token, 'page': page, 'per_page': per_page }
+                response = session.get("https://%s/admin/api/active_docs.json" % url, params=params, stream=True, timeout=10)
+                if response.status_code != 200:
+                    raise FetchError("Failed to fetch API specs from 3Scale. Response code is %d, %s\nInfo is %s" % (response.status_code, response.reason, ResponseBody(response)))
+                page_docs = 0
+                new_docs = 0
+                for api_doc in ThreeScaleFetcher.read_api_docs(response):
+                    page_docs += 1
+                    # stop if the server ignores the paging and returns the same ActiveDocs again
+                    if api_doc["id"] in seen_doc_ids:
+                        continue
+                    seen_doc_ids.add(api_doc["id"])
+                    new_docs += 1
+                    try:
+                        api_spec = ThreeScaleFetcher.read_api_spec(api_doc, spec_cache, logger)
+                    except (ValueError, KeyError, TypeError) as ex:
+                        # a broken ActiveDoc is skipped, the rest of the ActiveDocs are still fetched
+                        logger.error("Failed to read ActiveDoc %s from 3Scale - %s", api_doc["id"], ex)
+                        continue
+                    fetched_apis.add(api_spec.host_and_base_path)
+                    yield api_spec.host_and_base_path, api_spec
+                response.close()
+                total_docs += new_docs
+                if page_docs < per_page or new_docs == 0:
+                    break
+                page += 1
+            logger.info("Successfully fetched %d API specs from 3Scale", total_docs)
+            spec_cache.retain(key for doc_id in seen_doc_ids for key in ThreeScaleFetcher.get_cache_keys(doc_id))
+            logger.info("Fetched %d APIs from the 3Scale", len(fetched_apis))
         except requests.exceptions.RequestException as re:
-            logger.error("Error while trying to fetch API specs from 3Scale - error is %s", re)
-            return None
\ No newline at end of file
+            raise FetchError("Error while trying to fetch API specs from 3Scale - error is %s" % re)
+
+
+    @staticmethod
+    def get_session(url):
+        with ThreeScaleFetcher.sessions_lock:
+            session = ThreeScaleFetcher.sessions.get(url)
+            if session is None:
+                session = requests.Session()
+                ThreeScaleFetcher.sessions[url] = session
+            return session
+
+
+    @staticmethod
+    def read_api_docs(response):
+        if ijson is not None:
+            response.raw.decode_content = True
+            for api_doc in ijson.items(response.raw, "api_docs.item.api_doc", use_float=True):
+                yield api_doc
+        else:
+            for api in response.json()["api_docs"]:
+                yield api["api_doc"]
+
+
+    @staticmethod
+    def get_cache_keys(doc_id):
+        return "%s/meta" % doc_id, "%s/spec" % doc_id
+
+
+    @staticmethod
+    def read_api_spec(api_doc, spec_cache, logger):
+        meta_key, spec_key = ThreeScaleFetcher.get_cache_keys(api_doc["id"])
+        # an ActiveDoc which was not updated since the last run is served from the cache instead of being parsed again
+        cached_meta = spec_cache.get(meta_key)
+        if cached_meta is not None:
+            cached_meta = json.loads(cached_meta.decode("utf-8"))
+            cached_spec = spec_cache.get(spec_key)
+            if cached_spec is not None and cached_meta["updated_at"] == api_doc.get("updated_at"):
+                logger.debug("ActiveDoc %s was not updated in 3Scale - using the cached API spec", api_doc["id"])
+                return ApiSpec(cached_spec, cached_meta["key"])
+        # the ActiveDocs bodies may contain raw line breaks, so the control characters are allowed inside strings and the spec is serialized again
+        api_spec = ApiSpec.from_dict(json.loads(api_doc["body"], strict=False))
+        if api_doc.get("updated_at") is not None:
+            spec_cache.put(spec_key, api_spec.data)
+            spec_cache.put(meta_key, json.dumps({"updated_at": api_doc["updated_at"], "key": api_spec.host_and_base_path}).encode("utf-8"))
+        return api_spec
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import os
+
+try:
+    # ijson is optional - with it the existing APIs are parsed one by one while they are downloaded
+    import ijson
+except ImportError:
+    ijson = None
+
+from utils.AtomicFile import load_json, save_json
+
+
+class ApiIndex:
+
+    INDEX_VERSION = 1
+
+    def __init__(self, path, site_id, logger):
+        self.logger = logger
+        self.index_file = None
+        if path is not None and path:
+            self.index_file = os.path.join(path, "apis_%s.json" % site_id)
+
+
+    @staticmethod
+    def read_listing(response, site_id):
+        # yields the key, the ID and the server version of every listed API, and whether it is an API of the site - the rest of the API fields are not kept
+        if ijson is not None:
+            response.raw.decode_content = True
+            api_listing = ijson.items(response.raw, "value.item", use_float=True)
+        else:
+            api_listing = response.json()["value"]
+        for api_res in api_listing:
+            # the listing may include the APIs of the other sites of the account - they are still counted by the paging
+            is_site_api = api_res.get("siteId") is None or str(api_res["siteId"]) == str(site_id)
+            yield api_res["hostName"] + (api_res["basePath"] or "/"), api_res["id"], ApiIndex.get_server_version(api_res), is_site_api
+
+
+    @staticmethod
+    def get_server_version(api_res):
+        # the field which changes whenever the API is changed at Imperva, if the server returns one
+        for field_name in ("lastModified", "lastModifiedDate", "updatedAt", "version"):
+            if api_res.get(field_name) is not None:
+                return api_res[field_name]
+        return None
+
+
+    def load(self):
+        # returns the ETag and the existing APIs of the last full listing, or None if there is no cached listing
+        return load_json(self.index_file, self.INDEX_VERSION, "index of the existing APIs", self.logger)
+
+
+    def save(self, etag, existing_apis, server_versions):
+        if self.index_file is None:
+            return
+        try:
+            save_json(self.index_file, {"version": self.INDEX_VERSION, "etag": etag, "apis": existing_apis, "server_versions": server_versions})
+        except Exception as ex:
+            self.logger.error("Failed to save the index of the existing APIs to '%s'. Error is %s", self.index_file, ex)
+
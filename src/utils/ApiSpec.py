@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import codecs
+import hashlib
+import json
+import re
+from urllib.parse import urlparse
+
+# the tokens which are needed in order to find the top level fields of a JSON document without parsing all of it
+JSON_TOKENS = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]|-?[0-9][0-9.eE+-]*|true|false|null')
+
+
+class ApiSpec:
+
+    # after this many tokens it is cheaper to let the C based JSON parser find the routing fields
+    MAX_SCANNED_TOKENS = 10000
+
+    def __init__(self, data, host_and_base_path):
+        # the spec is kept as the JSON bytes which are uploaded to Imperva, so it is never parsed and serialized again
+        self.data = data
+        self.host_and_base_path = host_and_base_path
+        self.digest = hashlib.sha256(data).hexdigest()
+
+
+    @staticmethod
+    def from_dict(api_spec):
+        # a single canonical serialization for specs which had to be parsed anyway, such as YAML files
+        data = json.dumps(api_spec, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+        return ApiSpec(data, ApiSpec.get_key(api_spec))
+
+
+    @staticmethod
+    def from_json(data, host_and_base_path=None):
+        if data.startswith(codecs.BOM_UTF8):
+            data = data[len(codecs.BOM_UTF8):]
+        if host_and_base_path is None:
+            host_and_base_path = ApiSpec.get_routing_key(data)
+        return ApiSpec(data, host_and_base_path)
+
+
+    @staticmethod
+    def get_routing_key(data):
+        routing_fields = ApiSpec.scan_top_level_fields(data, (b'"host"', b'"basePath"'))
+        if routing_fields is None or not routing_fields[b'"host"']:
+            return ApiSpec.get_key(json.loads(data.decode("utf-8")))
+        # the same key as get_key gives, so an API spec has the same key whatever the format that it was fetched in
+        return routing_fields[b'"host"'] + (routing_fields[b'"basePath"'] or "/")
+
+
+    @staticmethod
+    def get_key(api_spec):
+        # the Swagger 2.0 host and base path, or the host and path of the first OpenAPI 3 server
+        if not isinstance(api_spec, dict):
+            raise ValueError("the API spec is not a JSON object")
+        if isinstance(api_spec.get("host"), str) and api_spec["host"]:
+            base_path = api_spec.get("basePath")
+            # without a base path the API is served directly under the host
+            return api_spec["host"] + (base_path if isinstance(base_path, str) and base_path else "/")
+        servers = api_spec.get("servers")
+        if isinstance(servers, list) and len(servers) > 0 and isinstance(servers[0], dict) and isinstance(servers[0].get("url"), str):
+            server_url = servers[0]["url"]
+            # the server variables are replaced by their default values
+            for name, variable in (servers[0].get("variables") or dict()).items():
+                if isinstance(variable, dict) and variable.get("default") is not None:
+                    server_url = server_url.replace("{%s}" % name, str(variable["default"]))
+            # a relative server URL has no host
+            if not server_url.startswith("/"):
+                parsed_url = urlparse(server_url if "//" in server_url else "//" + server_url)
+                if parsed_url.netloc:
+                    return parsed_url.netloc + (parsed_url.path.rstrip("/") or "/")
+        raise ValueError("the API spec has no host - it should have a host or an OpenAPI 3 server URL with a host")
+
+
+    @staticmethod
+    def scan_top_level_fields(data, field_names):
+        # returns the string values of the given top level fields, or None when they weren't found in the first tokens
+        found_fields = dict()
+        depth = 0
+        expect_key = True
+        key = None
+        for scanned_tokens, match in enumerate(JSON_TOKENS.finditer(data)):
+            if scanned_tokens >= ApiSpec.MAX_SCANNED_TOKENS:
+                return None
+            token = match.group()
+            if token in (b"{", b"["):
+                if depth == 1 and not expect_key:
+                    # a nested value of a top level field - the next top level string is a key again
+                    expect_key = True
+                depth += 1
+            elif token in (b"}", b"]"):
+                depth -= 1
+            elif depth == 1:
+                if expect_key:
+                    key = token
+                    expect_key = False
+                else:
+                    if key in field_names and token.startswith(b'"'):
+                        found_fields[key] = json.loads(token.decode("utf-8"))
+                        if len(found_fields) == len(field_names):
+                            return found_fields
+                    expect_key = True
+        return None
+
+
+    def to_dict(self):
+        return json.loads(self.data.decode("utf-8"))
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import json
+import os
+import tempfile
+
+
+def write_file(path, write, mode='w'):
+    # the content is written to a temporary file which then replaces the file, so a crash or a concurrent reader never sees a partially written file
+    file_dir = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(file_dir):
+        os.makedirs(file_dir)
+    fd, temp_file = tempfile.mkstemp(dir=file_dir, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as outfile:
+            write(outfile)
+        os.replace(temp_file, path)
+    except BaseException:
+        os.remove(temp_file)
+        raise
+
+
+def save_json(path, value):
+    write_file(path, lambda outfile: json.dump(value, outfile))
+
+
+def load_json(path, version, description, logger):
+    # returns the content of a JSON file which was saved with the given version, or None when it is missing, has another version or can't be read
+    if path is None or not os.path.isfile(path):
+        return None
+    try:
+        with open(path) as infile:
+            content = json.load(infile)
+        if content.get("version") != version:
+            logger.info("Ignoring the %s in '%s' since it has an unsupported version", description, path)
+            return None
+        return content
+    except Exception as ex:
+        logger.error("Failed to load the %s from '%s'. Error is %s", description, path, ex)
+        return None
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import hashlib
+import os
+import time
+
+from utils.AtomicFile import write_file
+
+
+class FileCache:
+
+    def __init__(self, path, logger):
+        self.logger = logger
+        self.path = path if path is not None and path else None
+        if self.path is not None and not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+
+    def enabled(self):
+        return self.path is not None
+
+
+    def get_file_path(self, key):
+        return os.path.join(self.path, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+
+    def get(self, key):
+        if self.path is None:
+            return None
+        try:
+            with open(self.get_file_path(key), 'rb') as cache_file:
+                return cache_file.read()
+        except (IOError, OSError):
+            return None
+
+
+    def put(self, key, data):
+        if self.path is None:
+            return
+        try:
+            # concurrent readers never see a partially written entry
+            write_file(self.get_file_path(key), lambda outfile: outfile.write(data), 'wb')
+        except (IOError, OSError) as ex:
+            self.logger.error("Failed to write to the cache at '%s'. Error is %s", self.path, ex)
+
+
+    def retain(self, keys, min_age=0):
+        # remove the entries which are no longer used, so the cache directory won't grow forever - entries which were written
+        # in the last min_age seconds are kept, since they may belong to a writer which is still running
+        if self.path is None:
+            return
+        file_names = set(os.path.basename(self.get_file_path(key)) for key in keys)
+        for file_name in os.listdir(self.path):
+            if file_name not in file_names:
+                try:
+                    if min_age > 0 and time.time() - os.path.getmtime(os.path.join(self.path, file_name)) < min_age:
+                        continue
+                    os.remove(os.path.join(self.path, file_name))
+                except OSError as ex:
+                    self.logger.debug("Failed to remove the cache entry '%s'. Error is %s", file_name, ex)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from utils.Metrics import Metrics
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+class RateLimiter:
+
+    def __init__(self, initial_rps, min_rps, max_rps):
+        self.rps = float(initial_rps)
+        self.min_rps = float(min_rps)
+        self.max_rps = float(max_rps)
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+        self.last_decrease = 0
+
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + 1.0 / self.rps
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+    def on_success(self):
+        # additive increase - about one more request per second for every second of successful calls
+        with self.lock:
+            self.rps = min(self.max_rps, self.rps + 1.0 / self.rps)
+
+
+    def on_throttle(self):
+        # multiplicative decrease - concurrent calls usually get throttled together so we decrease once per interval
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_decrease >= 1.0 / self.rps:
+                self.rps = max(self.min_rps, self.rps / 2)
+                self.last_decrease = now
+
+
+    def pause(self, seconds):
+        with self.lock:
+            self.next_time = max(self.next_time, time.monotonic() + seconds)
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+
+    def before_call(self):
+        if self.is_open():
+            raise CircuitOpenError("The Imperva management URL is unavailable - not sending more requests for now")
+
+
+    def on_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+
+    def on_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                # after the reset timeout the calls are let through again - if they keep failing the circuit opens again
+                self.opened_at = time.monotonic()
+
+
+class ImpervaClient:
+
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(self, config, logger):
+        self.logger = logger
+        self.management_url = config.MANAGEMENT_URL
+        self.auth_params = "?api_id=%s&api_key=%s" % (config.API_ID, config.API_KEY)
+        self.timeout = config.CLIENT_TIMEOUT
+        self.max_retries = config.CLIENT_MAX_RETRIES
+        self.backoff_base = config.CLIENT_BACKOFF_BASE
+        self.backoff_max = config.CLIENT_BACKOFF_MAX
+        self.rate_limiter = RateLimiter(config.CLIENT_INITIAL_RPS, config.CLIENT_MIN_RPS, config.CLIENT_MAX_RPS)
+        self.circuit_breaker = CircuitBreaker(config.CLIENT_CIRCUIT_BREAKER_THRESHOLD, config.CLIENT_CIRCUIT_BREAKER_RESET)
+        self.session = self.create_session(config.CONCURRENCY)
+        # the metrics of the current run - the manager sets new metrics for every run
+        self.metrics = Metrics()
+
+
+    def create_session(self, concurrency):
+        # a single session with a connection pool per worker, so the TLS connections are kept alive and reused by all the calls
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+
+    def build_url(self, *path):
+        return self.management_url + "/".join(path) + self.auth_params
+
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+
+    def post(self, url, idempotent=False, **kwargs):
+        return self.request("POST", url, idempotent=idempotent, **kwargs)
+
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+    def request(self, method, url, idempotent=True, **kwargs):
+        # a request which is not idempotent, such as an upload which creates an API, is retried only when the server surely didn't
+        # process it - when the connection could not be made or the server throttled it - otherwise the retry may create a duplicate
+        attempt = 0
+        while True:
+            self.circuit_breaker.before_call()
+            self.rate_limiter.acquire()
+            request_start = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+                self.metrics.increment("requests_total", {"method": method, "status": "error"})
+                self.circuit_breaker.on_failure()
+                if attempt >= self.max_retries or not (idempotent or self.is_unsent(ex)):
+                    raise
+                delay = self.get_backoff(attempt)
+                self.logger.debug("%s request to Imperva failed with '%s' - retrying in %.2f seconds", method, ex, delay)
+                self.metrics.increment("retries_total", {"method": method, "reason": "connection"})
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.record_response(method, response, time.monotonic() - request_start)
+            if response.status_code not in self.RETRY_STATUS_CODES:
+                self.circuit_breaker.on_success()
+                self.rate_limiter.on_success()
+                return response
+            retry_after = self.get_retry_after(response)
+            # a 503 is throttling only with a Retry-After - otherwise the server is down, and the circuit should open
+            throttled = response.status_code == 429 or (response.status_code == 503 and retry_after is not None)
+            if throttled:
+                # the server is up but we are going too fast for it
+                self.circuit_breaker.on_success()
+                self.rate_limiter.on_throttle()
+            else:
+                self.circuit_breaker.on_failure()
+            if attempt >= self.max_retries or not (idempotent or throttled):
+                return response
+            # the response is retried, so its connection goes back to the pool
+            response.close()
+            self.metrics.increment("retries_total", {"method": method, "reason": "throttled" if throttled else "error"})
+            if retry_after is not None:
+                # a Retry-After applies to all the calls, so we pause the shared limiter instead of only this call
+                self.logger.debug("%s request to Imperva got %d - all requests are paused for %.2f seconds", method, response.status_code, retry_after)
+                self.rate_limiter.pause(retry_after)
+            else:
+                delay = self.get_backoff(attempt)
+                self.logger.debug("%s request to Imperva got %d - retrying in %.2f seconds", method, response.status_code, delay)
+                time.sleep(delay)
+            attempt += 1
+
+
+    @staticmethod
+    def is_unsent(ex):
+        # whether the request failed before it was sent - the connection timed out or was refused
+        if isinstance(ex, requests.exceptions.ConnectTimeout):
+            return True
+        reason = getattr(ex.args[0], "reason", None) if len(ex.args) > 0 else None
+        return isinstance(ex, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+    def record_response(self, method, response, latency):
+        # the latency is until the response headers, since the listing of the existing APIs is streamed
+        self.metrics.observe("request_duration_seconds", latency, {"method": method})
+        self.metrics.increment("requests_total", {"method": method, "status": str(response.status_code)})
+        body = response.request.body if response.request is not None else None
+        if body is not None:
+            self.metrics.increment("bytes_sent_total", amount=len(body))
+
+
+    def get_backoff(self, attempt):
+        # exponential backoff with full jitter so the concurrent workers won't retry in lockstep
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+
+    def get_retry_after(self, response):
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is None:
+            return None
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (AttributeError, TypeError, ValueError):
+                return None
+        return max(0.0, seconds)
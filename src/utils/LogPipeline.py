@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import atexit
+import json
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+# the default number of bytes of a response body which are logged
+MAX_BODY_SIZE = 2048
+# the number of bytes of a response body which are logged when no limit is given - set from the logging settings
+max_body_size = MAX_BODY_SIZE
+
+
+def set_max_body_size(limit):
+    global max_body_size
+    max_body_size = limit
+
+
+class ResponseBody:
+
+    # the body of a response as a log argument - it is read, decoded and truncated only if the log record is formatted
+
+    def __init__(self, response, limit=None):
+        self.response = response
+        self.limit = limit if limit is not None else max_body_size
+
+
+    def __str__(self):
+        try:
+            content = self.response.content or b""
+            text = content[:self.limit].decode(self.response.encoding or "utf-8", errors="replace")
+        except Exception:
+            return "<the response body is not available>"
+        if len(content) > self.limit:
+            text += "... (%d more bytes)" % (len(content) - self.limit)
+        return text
+
+
+class LazyJson:
+
+    # a JSON log argument which is serialized only if the log record is formatted
+
+    def __init__(self, value):
+        self.value = value
+
+
+    def __str__(self):
+        return json.dumps(self.value, default=str)
+
+
+class JsonFormatter(logging.Formatter):
+
+    # the fields of the API which a log record is about, given with the extra argument of the log call
+    API_FIELDS = ("site_id", "api", "api_id", "action", "status_code", "fetcher")
+
+    def format(self, record):
+        log_record = {"time": self.formatTime(record), "level": record.levelname, "thread": record.threadName, "message": record.getMessage()}
+        for field in self.API_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                log_record[field] = value
+        if record.exc_info:
+            log_record["exception"] = self.formatException(record.exc_info)
+        return json.dumps(log_record, default=str)
+
+
+class LogQueueHandler(QueueHandler):
+
+    # the records are passed as they are to the listener thread in this process, so they are formatted there and not by the caller
+
+    def __init__(self, target_handlers):
+        super().__init__(queue.Queue())
+        self.target_handlers = target_handlers
+        self.start_listener()
+
+
+    def start_listener(self):
+        self.pid = os.getpid()
+        self.listener = QueueListener(self.queue, *self.target_handlers, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.listener.stop)
+
+
+    def prepare(self, record):
+        return record
+
+
+    def ensure_listener(self):
+        # a forked worker process has a copy of the handler but not the listener thread, so it starts its own listener with a new queue
+        if self.pid != os.getpid():
+            self.queue = queue.Queue()
+            self.start_listener()
+
+
+    def flush(self):
+        # waits until the records which were logged so far are written
+        if self.pid == os.getpid():
+            self.queue.join()
+
+
+def flush_logs(logger):
+    for handler in logger.handlers:
+        handler.flush()
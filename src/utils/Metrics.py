@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from utils.AtomicFile import write_file
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.bucket_counts[index] += 1
+                break
+
+
+    def get_cumulative_counts(self):
+        cumulative_counts = []
+        total = 0
+        for bucket_count in self.bucket_counts:
+            total += bucket_count
+            cumulative_counts.append(total)
+        return cumulative_counts
+
+
+class Metrics:
+
+    PREFIX = "imperva_api_security_"
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+    def __init__(self):
+        # the metrics are updated by the concurrent sync workers, so all the updates are guarded by this lock
+        self.lock = threading.Lock()
+        self.phases = dict()
+        self.counters = dict()
+        self.histograms = dict()
+
+
+    @contextmanager
+    def phase(self, name):
+        phase_start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.monotonic() - phase_start)
+
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+
+    def increment(self, name, labels=None, amount=1):
+        key = (name, self.get_labels_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+
+    def observe(self, name, value, labels=None, buckets=LATENCY_BUCKETS):
+        key = (name, self.get_labels_key(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+
+    def get_counter(self, name):
+        # the total of a counter over all its labels
+        with self.lock:
+            return sum(value for (counter_name, labels_key), value in self.counters.items() if counter_name == name)
+
+
+    @staticmethod
+    def get_labels_key(labels):
+        return tuple(sorted((labels or dict()).items()))
+
+
+    @staticmethod
+    def format_labels(labels_key, extra_labels=()):
+        labels = list(labels_key) + list(extra_labels)
+        if len(labels) == 0:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in labels)
+
+
+    def to_dict(self):
+        # the metrics of the status report - the labels of every value are joined into a single key
+        with self.lock:
+            metrics = {"phases": dict((name, round(seconds, 3)) for name, seconds in self.phases.items()), "counters": dict(), "histograms": dict()}
+            for (name, labels_key), value in sorted(self.counters.items()):
+                metrics["counters"].setdefault(name, dict())[",".join("%s=%s" % label for label in labels_key)] = value
+            for (name, labels_key), histogram in sorted(self.histograms.items()):
+                metrics["histograms"].setdefault(name, dict())[",".join("%s=%s" % label for label in labels_key)] = {
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 3),
+                    "buckets": dict(zip([str(bucket) for bucket in histogram.buckets], histogram.get_cumulative_counts()))
+                }
+            return metrics
+
+
+    def to_prometheus(self):
+        # the Prometheus text exposition format
+        lines = []
+        with self.lock:
+            lines.append("# TYPE %sphase_seconds gauge" % self.PREFIX)
+            for name, seconds in sorted(self.phases.items()):
+                lines.append("%sphase_seconds%s %.6f" % (self.PREFIX, self.format_labels((("phase", name),)), seconds))
+            typed_names = set()
+            for (name, labels_key), value in sorted(self.counters.items()):
+                if name not in typed_names:
+                    lines.append("# TYPE %s%s counter" % (self.PREFIX, name))
+                    typed_names.add(name)
+                lines.append("%s%s%s %s" % (self.PREFIX, name, self.format_labels(labels_key), value))
+            for (name, labels_key), histogram in sorted(self.histograms.items()):
+                if name not in typed_names:
+                    lines.append("# TYPE %s%s histogram" % (self.PREFIX, name))
+                    typed_names.add(name)
+                for bucket, cumulative_count in zip(histogram.buckets, histogram.get_cumulative_counts()):
+                    lines.append("%s%s_bucket%s %d" % (self.PREFIX, name, self.format_labels(labels_key, (("le", str(bucket)),)), cumulative_count))
+                lines.append("%s%s_bucket%s %d" % (self.PREFIX, name, self.format_labels(labels_key, (("le", "+Inf"),)), histogram.count))
+                lines.append("%s%s_sum%s %.6f" % (self.PREFIX, name, self.format_labels(labels_key), histogram.sum))
+                lines.append("%s%s_count%s %d" % (self.PREFIX, name, self.format_labels(labels_key), histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+    def write_prometheus(self, path, logger):
+        try:
+            prometheus_text = self.to_prometheus()
+            write_file(path, lambda outfile: outfile.write(prometheus_text))
+        except Exception as ex:
+            logger.error("Failed to write the metrics to '%s'. Error is %s", path, ex)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        # the metrics of the last finished run
+        body = self.server.get_metrics().to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(host, port, get_metrics):
+    server = MetricsServer((host, port), MetricsHandler)
+    server.get_metrics = get_metrics
+    threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+    return server
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import gzip
+import os
+import re
+import time
+
+from utils.ApiSpec import ApiSpec
+from utils.AtomicFile import load_json, save_json
+from utils.FileCache import FileCache
+
+
+class SnapshotStore:
+
+    # the API specs of the last successful fetch of every fetcher - the API specs are stored compressed by their digest,
+    # so an API spec which did not change, or which is fetched by a few fetchers, is stored once
+
+    SNAPSHOT_VERSION = 1
+    # an API spec which is not in any snapshot is removed only after this time, since a fetcher may still be writing its snapshot
+    MIN_UNUSED_AGE = 3600
+
+    def __init__(self, path, logger):
+        self.logger = logger
+        self.path = path if path is not None and path else None
+        self.spec_cache = FileCache(os.path.join(self.path, "specs") if self.path is not None else None, logger)
+
+
+    def enabled(self):
+        return self.path is not None
+
+
+    def get_snapshot_file(self, fetcher_id):
+        return os.path.join(self.path, "snapshot_%s.json" % re.sub(r"[^A-Za-z0-9_.-]", "_", fetcher_id))
+
+
+    def add(self, api_spec):
+        # called by the fetcher threads while they fetch - an API spec which is already stored is not compressed again
+        if not os.path.isfile(self.spec_cache.get_file_path(api_spec.digest)):
+            self.spec_cache.put(api_spec.digest, gzip.compress(api_spec.data, compresslevel=6))
+
+
+    def load(self, fetcher_id):
+        # returns the snapshot of the fetcher, or None when it has no snapshot
+        return load_json(self.get_snapshot_file(fetcher_id), self.SNAPSHOT_VERSION, "snapshot of %s" % fetcher_id, self.logger)
+
+
+    def save(self, fetcher_id, apis):
+        # returns the keys which were added, changed and removed since the previous snapshot - only the digests are compared
+        previous_snapshot = self.load(fetcher_id)
+        previous_apis = previous_snapshot["apis"] if previous_snapshot is not None else dict()
+        added_keys = [key for key in apis if key not in previous_apis]
+        changed_keys = [key for key, digest in apis.items() if key in previous_apis and previous_apis[key] != digest]
+        removed_keys = [key for key in previous_apis if key not in apis]
+        snapshot_file = self.get_snapshot_file(fetcher_id)
+        try:
+            save_json(snapshot_file, {"version": self.SNAPSHOT_VERSION, "fetcher_id": fetcher_id, "time": time.time(), "apis": apis})
+        except Exception as ex:
+            self.logger.error("Failed to save the snapshot of %s to '%s'. Error is %s", fetcher_id, snapshot_file, ex)
+        return added_keys, changed_keys, removed_keys
+
+
+    def read(self, snapshot, skipped_keys):
+        # the API specs of the snapshot, except those that were already fetched
+        for host_and_base_path, digest in snapshot["apis"].items():
+            if host_and_base_path in skipped_keys:
+                continue
+            data = self.spec_cache.get(digest)
+            if data is None:
+                self.logger.error("The API spec of '%s' is missing from the snapshot of %s", host_and_base_path, snapshot["fetcher_id"])
+                continue
+            yield host_and_base_path, ApiSpec(gzip.decompress(data), host_and_base_path)
+
+
+    def cleanup(self):
+        # remove the API specs which are no longer in any snapshot, so the store won't grow forever
+        used_digests = set()
+        for file_name in os.listdir(self.path):
+            if file_name.startswith("snapshot_") and file_name.endswith(".json"):
+                snapshot = self.load(file_name[len("snapshot_"):-len(".json")])
+                if snapshot is None:
+                    # the API specs of a snapshot which can't be read are kept rather than guessed
+                    return
+                used_digests.update(snapshot["apis"].values())
+        self.spec_cache.retain(used_digests, self.MIN_UNUSED_AGE)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import os
+import threading
+
+from utils.AtomicFile import load_json, save_json
+
+
+class SpecQuarantine:
+
+    # the API specs which failed the validation, by their digest - they are not pushed again until they change
+
+    QUARANTINE_VERSION = 1
+
+    def __init__(self, path, site_id, logger):
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.quarantine_file = None
+        if path is not None and path:
+            self.quarantine_file = os.path.join(path, "quarantine_%s.json" % site_id)
+        self.specs = dict()
+        # the quarantined API specs which were fetched since the last pruning save - the rest were changed or removed
+        self.seen_digests = set()
+
+
+    def load(self):
+        # the API specs are validated again if the quarantine can't be loaded
+        quarantine = load_json(self.quarantine_file, self.QUARANTINE_VERSION, "quarantined API specs", self.logger)
+        if quarantine is not None:
+            self.specs = quarantine["specs"]
+
+
+    def get(self, digest):
+        # returns the reason that the API spec was quarantined, or None if it was not
+        with self.lock:
+            quarantined_spec = self.specs.get(digest)
+            if quarantined_spec is None:
+                return None
+            self.seen_digests.add(digest)
+            return quarantined_spec["reason"]
+
+
+    def add(self, digest, host_and_base_path, reason):
+        with self.lock:
+            self.specs[digest] = {"key": host_and_base_path, "reason": reason}
+            self.seen_digests.add(digest)
+
+
+    def save(self, prune=False):
+        # the API specs which were not fetched are removed only after a sync which fetched all the APIs, since a partial sync
+        # doesn't know whether they were changed or removed
+        with self.lock:
+            if prune:
+                self.specs = dict((digest, quarantined_spec) for digest, quarantined_spec in self.specs.items() if digest in self.seen_digests)
+                self.seen_digests = set()
+            specs = dict(self.specs)
+        if self.quarantine_file is None:
+            return
+        try:
+            save_json(self.quarantine_file, {"version": self.QUARANTINE_VERSION, "specs": specs})
+        except Exception as ex:
+            self.logger.error("Failed to save the quarantined API specs to '%s'. Error is %s", self.quarantine_file, ex)
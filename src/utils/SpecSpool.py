@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import json
+import os
+import re
+
+from fetchers.FetchError import FetchError
+from utils.ApiSpec import ApiSpec
+from utils.FileCache import FileCache
+
+
+class SpecSpool:
+
+    # the API specs which were fetched once for all the sites of a multi-site run - every site reads them in its own process
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.spec_cache = FileCache(os.path.join(path, "specs"), logger)
+        self.spooled_digests = set()
+        self.listings = dict()
+
+
+    def add(self, listing_name, host_and_base_path, api_spec):
+        # the API specs are stored once by their digest, even if a few fetchers returned the same API spec
+        if api_spec.digest not in self.spooled_digests:
+            self.spec_cache.put(api_spec.digest, api_spec.data)
+            self.spooled_digests.add(api_spec.digest)
+        if listing_name not in self.listings:
+            self.listings[listing_name] = open(os.path.join(self.path, listing_name + ".jsonl"), 'w')
+        self.listings[listing_name].write(json.dumps([host_and_base_path, api_spec.digest]) + "\n")
+
+
+    def close(self):
+        for listing in self.listings.values():
+            listing.close()
+        self.listings = dict()
+
+
+    @staticmethod
+    def read(spool_path, listing_name, logger, key_filter=None):
+        # the spooled API specs of a listing, in the order that they were added
+        spec_cache = FileCache(os.path.join(spool_path, "specs"), logger)
+        listing_file = os.path.join(spool_path, listing_name + ".jsonl")
+        if not os.path.isfile(listing_file):
+            return
+        with open(listing_file) as listing:
+            for line in listing:
+                host_and_base_path, digest = json.loads(line)
+                if key_filter is not None and not key_filter.search(host_and_base_path):
+                    continue
+                data = spec_cache.get(digest)
+                if data is None:
+                    raise FetchError("The spooled API spec of '%s' is missing" % host_and_base_path)
+                yield host_and_base_path, ApiSpec(data, host_and_base_path)
+
+
+    @staticmethod
+    def fetch(settings, logger, status):
+        # the same interface as the fetchers, so a site syncs the spooled API specs exactly like fetched API specs
+        key_filter = re.compile(settings["key_filter"]) if settings.get("key_filter") else None
+        for host_and_base_path, api_spec in SpecSpool.read(settings["spool_path"], settings["listing"], logger, key_filter):
+            yield host_and_base_path, api_spec
+        if settings.get("snapshot"):
+            status.update_fetcher_snapshot(settings["fetcher_type"])
+        for region in settings["regions"]["success"]:
+            status.update_fetcher_region_success(region)
+        for region in settings["regions"]["error"]:
+            status.update_fetcher_region_error(region)
+        if settings["failed"]:
+            raise FetchError("Failed to fetch APIs from %s for all the sites" % settings["fetcher_id"])
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import hashlib
+import json
+
+# the maps whose keys are names given by the API owner rather than spec fields, so a name such as "x-request-id" is never stripped
+NAMED_MAPS = {"paths", "properties", "patternProperties", "definitions", "schemas", "parameters", "responses", "headers", "securityDefinitions",
+              "securitySchemes", "requestBodies", "callbacks", "links", "variables", "content", "mapping", "scopes", "encoding"}
+
+
+class SpecTransform:
+
+    # inline schemas which are shorter than this are cheaper to repeat than to reference
+    MIN_DEDUPE_SIZE = 64
+
+    def __init__(self, settings):
+        settings = settings or dict()
+        self.strip_extensions = tuple(settings.get("strip_extensions", ()))
+        self.strip_examples = settings.get("strip_examples", False)
+        self.dedupe_schemas = settings.get("dedupe_schemas", False)
+        self.minify = settings.get("minify", False)
+        self.settings = {"strip_extensions": list(self.strip_extensions), "strip_examples": self.strip_examples, "dedupe_schemas": self.dedupe_schemas, "minify": self.minify}
+        # the state keeps the digest of the fetched API spec with the transform settings, so a change of the settings pushes the APIs again
+        self.fingerprint = hashlib.sha256(json.dumps(self.settings, sort_keys=True).encode("utf-8")).hexdigest()[:12] if self.is_active() else None
+
+
+    def is_active(self):
+        return len(self.strip_extensions) > 0 or self.strip_examples or self.dedupe_schemas or self.minify
+
+
+    def get_digest(self, api_spec):
+        if self.fingerprint is None:
+            return api_spec.digest
+        return "%s-%s" % (api_spec.digest, self.fingerprint)
+
+
+    def apply(self, data):
+        # the API spec is transformed only when it is pushed, so the API specs which did not change are never parsed
+        if not self.is_active():
+            return data
+        api_spec = json.loads(data.decode("utf-8"))
+        if not isinstance(api_spec, dict):
+            return data
+        if len(self.strip_extensions) > 0 or self.strip_examples:
+            api_spec = self.strip(api_spec, False)
+        if self.dedupe_schemas:
+            self.dedupe(api_spec)
+        if self.minify:
+            return json.dumps(api_spec, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        return json.dumps(api_spec, ensure_ascii=False).encode("utf-8")
+
+
+    def strip(self, value, named_map):
+        if isinstance(value, dict):
+            stripped = dict()
+            for key, item in value.items():
+                if not named_map and self.is_stripped(key):
+                    continue
+                stripped[key] = self.strip(item, not named_map and key in NAMED_MAPS)
+            return stripped
+        if isinstance(value, list):
+            return [self.strip(item, False) for item in value]
+        return value
+
+
+    def is_stripped(self, key):
+        if self.strip_examples and key in ("example", "examples", "x-example", "x-examples"):
+            return True
+        return key.startswith(self.strip_extensions) if len(self.strip_extensions) > 0 else False
+
+
+    def dedupe(self, api_spec):
+        # the inline schemas which repeat, or which repeat a defined schema, are replaced by a reference to a single definition
+        if "openapi" in api_spec:
+            definitions = api_spec.setdefault("components", dict()).setdefault("schemas", dict())
+            ref_prefix = "#/components/schemas/"
+        else:
+            definitions = api_spec.setdefault("definitions", dict())
+            ref_prefix = "#/definitions/"
+        defined_schemas = dict()
+        for name, schema in definitions.items():
+            defined_schemas.setdefault(self.get_schema_key(schema), name)
+        inline_schemas = dict()
+        for parent, key in self.find_inline_schemas(api_spec, False):
+            inline_schemas.setdefault(self.get_schema_key(parent[key]), []).append((parent, key))
+        for schema_key, locations in inline_schemas.items():
+            if schema_key not in defined_schemas:
+                if len(locations) < 2 or len(schema_key) < self.MIN_DEDUPE_SIZE:
+                    continue
+                name = "Schema" + hashlib.sha256(schema_key.encode("utf-8")).hexdigest()[:8]
+                definitions[name] = locations[0][0][locations[0][1]]
+                defined_schemas[schema_key] = name
+            for parent, key in locations:
+                parent[key] = {"$ref": ref_prefix + defined_schemas[schema_key]}
+        if len(definitions) == 0:
+            if ref_prefix == "#/definitions/":
+                del api_spec["definitions"]
+            elif len(api_spec["components"]) == 1:
+                del api_spec["components"]
+            else:
+                del api_spec["components"]["schemas"]
+
+
+    def find_inline_schemas(self, value, named_map):
+        # the schemas of the parameters, the request bodies and the responses - the definitions themselves are left as they are
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if not named_map and key in ("definitions", "components"):
+                    continue
+                if not named_map and key == "schema" and isinstance(item, dict) and "$ref" not in item:
+                    yield value, key
+                else:
+                    for location in self.find_inline_schemas(item, not named_map and key in NAMED_MAPS):
+                        yield location
+        elif isinstance(value, list):
+            for item in value:
+                for location in self.find_inline_schemas(item, False):
+                    yield location
+
+
+    @staticmethod
+    def get_schema_key(schema):
+        return json.dumps(schema, sort_keys=True, separators=(",", ":"))
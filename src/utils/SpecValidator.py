@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import json
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    # openapi-spec-validator is optional - with it the API specs are validated against the Swagger 2.0 and OpenAPI 3 schemas,
+    # otherwise only their structure is checked. Its schema validators are compiled on their first use and cached by it
+    from jsonschema.exceptions import best_match
+    from openapi_spec_validator.schemas import openapi_v2_schema_validator, openapi_v30_schema_validator, openapi_v31_schema_validator
+except ImportError:
+    openapi_v2_schema_validator = openapi_v30_schema_validator = openapi_v31_schema_validator = None
+
+HTTP_METHODS = {"get", "put", "post", "delete", "options", "head", "patch", "trace"}
+
+
+def validate_api_spec(data):
+    # runs in a worker process, so it returns the reason that the API spec is invalid instead of logging it - None when it is valid
+    try:
+        api_spec = json.loads(data.decode("utf-8"))
+        if not isinstance(api_spec, dict):
+            return "it is not a JSON object"
+        if api_spec.get("swagger") == "2.0":
+            schema_validator = openapi_v2_schema_validator
+        elif isinstance(api_spec.get("openapi"), str) and api_spec["openapi"].startswith("3.0"):
+            schema_validator = openapi_v30_schema_validator
+        elif isinstance(api_spec.get("openapi"), str) and api_spec["openapi"].startswith("3.1"):
+            schema_validator = openapi_v31_schema_validator
+        else:
+            return "it is not a Swagger 2.0 or an OpenAPI 3 spec"
+        if schema_validator is not None:
+            error = best_match(schema_validator.iter_errors(api_spec))
+            if error is None:
+                return None
+            return "%s at '%s'" % (error.message, "/".join(str(part) for part in error.absolute_path))
+        return check_structure(api_spec)
+    except Exception as ex:
+        return "couldn't validate it - %s" % ex
+
+
+def check_structure(api_spec):
+    # the fields that Imperva needs in order to protect the API - used when openapi-spec-validator is not installed
+    if not isinstance(api_spec.get("info"), dict) or "title" not in api_spec["info"] or "version" not in api_spec["info"]:
+        return "it has no info with a title and a version"
+    paths = api_spec.get("paths")
+    if paths is None and str(api_spec.get("openapi")).startswith("3.1"):
+        return None
+    if not isinstance(paths, dict):
+        return "it has no paths"
+    for path, path_item in paths.items():
+        if path.startswith("x-"):
+            continue
+        if not path.startswith("/"):
+            return "the path '%s' does not start with a slash" % path
+        if not isinstance(path_item, dict):
+            return "the path '%s' is not an object" % path
+        for method, operation in path_item.items():
+            if method in HTTP_METHODS and (not isinstance(operation, dict) or not isinstance(operation.get("responses", dict()), dict)):
+                return "the %s operation of the path '%s' is not an object with responses" % (method, path)
+    return None
+
+
+class SpecValidator:
+
+    # the number of times that an API spec is validated in a new pool when a validation process dies
+    MAX_ATTEMPTS = 2
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+
+    def validate(self, data):
+        # called by the sync workers - the validation itself is CPU bound, so it runs in a pool of processes
+        if self.workers <= 1:
+            return validate_api_spec(data)
+        for attempt in range(self.MAX_ATTEMPTS):
+            executor = self.get_executor()
+            try:
+                return executor.submit(validate_api_spec, data).result()
+            except BrokenProcessPool:
+                # a validation process died, which breaks the whole pool - it is replaced, so the next API specs are still validated
+                self.drop_executor(executor)
+        return "couldn't validate it - the validation process failed"
+
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # the pool is started by the sync threads, so its processes are spawned instead of forked from a process with running threads
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.executor
+
+
+    def drop_executor(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+
+    def close(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import json
+import os
+import threading
+
+from utils.AtomicFile import load_json, save_json
+
+
+class StateStore:
+
+    STATE_VERSION = 2
+
+    def __init__(self, path, site_id, logger):
+        self.logger = logger
+        self.state_file = None
+        self.journal_file = None
+        if path is not None and path:
+            self.state_file = os.path.join(path, "state_%s.json" % site_id)
+            # every operation is appended to the journal as it is planned and completed, so an interrupted run doesn't lose its progress
+            self.journal_file = os.path.join(path, "journal_%s.jsonl" % site_id)
+        self.lock = threading.Lock()
+        self.journal = None
+        self.apis = dict()
+        # the APIs which were fetched more than once, by a few fetchers or by a few files of a fetcher
+        self.duplicate_keys = set()
+
+
+    def load(self):
+        self.load_state()
+        self.replay_journal()
+
+
+    def load_state(self):
+        if self.state_file is None or not os.path.isfile(self.state_file):
+            self.logger.debug("No local state was found - all the fetched APIs will be pushed to Imperva")
+            return
+        # a corrupted state only means that we push everything again, so we don't fail the run on it
+        state = load_json(self.state_file, self.STATE_VERSION, "local state", self.logger)
+        if state is None:
+            return
+        self.apis = state["apis"]
+        self.duplicate_keys = set(state.get("duplicate_keys", ()))
+        self.logger.info("Loaded the local state of %d APIs from '%s'", len(self.apis), self.state_file)
+
+
+    def replay_journal(self):
+        # applies the operations which were completed by an interrupted run, so they are not pushed again
+        if self.journal_file is None or not os.path.isfile(self.journal_file):
+            return
+        completed_operations = 0
+        pending_operations = set()
+        try:
+            with open(self.journal_file) as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line may be partially written if the run was killed
+                        continue
+                    if record["op"] == "planned":
+                        pending_operations.add(record["key"])
+                    elif record["op"] == "done":
+                        self.apis[record["key"]] = {"digest": record["digest"], "id": record["id"], "server_version": record.get("server_version")}
+                        pending_operations.discard(record["key"])
+                        completed_operations += 1
+                    elif record["op"] == "removed":
+                        self.apis.pop(record["key"], None)
+                        pending_operations.discard(record["key"])
+                        completed_operations += 1
+        except Exception as ex:
+            self.logger.error("Failed to read the journal from '%s'. Error is %s", self.journal_file, ex)
+        self.logger.info("Resuming an interrupted run - %d operations were completed and %d operations were not", completed_operations, len(pending_operations))
+        self.save()
+
+
+    def save(self):
+        if self.state_file is None:
+            return
+        try:
+            with self.lock:
+                save_json(self.state_file, {"version": self.STATE_VERSION, "apis": self.apis, "duplicate_keys": sorted(self.duplicate_keys)})
+                # the saved state includes all the journaled operations
+                if self.journal is not None:
+                    self.journal.close()
+                    self.journal = None
+                if os.path.exists(self.journal_file):
+                    os.remove(self.journal_file)
+            self.logger.debug("Saved the local state of %d APIs to '%s'", len(self.apis), self.state_file)
+        except Exception as ex:
+            self.logger.error("Failed to save the local state to '%s'. Error is %s", self.state_file, ex)
+
+
+    def is_unchanged(self, host_and_base_path, digest, api_id, server_version=None):
+        api_state = self.apis.get(host_and_base_path)
+        if api_state is None or api_state["digest"] != digest:
+            return False
+        # an API which was changed at Imperva since we last saw it should be pushed again
+        if server_version is not None and api_state.get("server_version") not in (None, server_version):
+            return False
+        # an API which was re-created at Imperva under a different ID should be pushed again
+        return api_state["id"] is None or api_state["id"] == api_id
+
+
+    def update(self, host_and_base_path, digest, api_id, server_version=None):
+        # the server version of a pushed API is not known until the APIs are read again
+        api_state = {"digest": digest, "id": api_id, "server_version": server_version}
+        with self.lock:
+            if self.apis.get(host_and_base_path) != api_state:
+                self.apis[host_and_base_path] = api_state
+                self.append_to_journal({"op": "done", "key": host_and_base_path, "digest": digest, "id": api_id, "server_version": server_version})
+
+
+    def is_duplicate(self, host_and_base_path):
+        return host_and_base_path in self.duplicate_keys
+
+
+    def update_duplicates(self, fetched_keys, duplicate_keys):
+        # the APIs which were not fetched now, e.g. since their fetcher failed, keep what was known about them
+        with self.lock:
+            self.duplicate_keys = (self.duplicate_keys - set(fetched_keys)) | set(duplicate_keys)
+
+
+    def remove(self, host_and_base_path):
+        with self.lock:
+            self.apis.pop(host_and_base_path, None)
+            self.append_to_journal({"op": "removed", "key": host_and_base_path})
+
+
+    def plan(self, action, host_and_base_path):
+        with self.lock:
+            self.append_to_journal({"op": "planned", "action": action, "key": host_and_base_path})
+
+
+    def append_to_journal(self, record):
+        # called with the lock held - every record is flushed, so it survives a killed process
+        if self.journal_file is None:
+            return
+        try:
+            if self.journal is None:
+                if not os.path.exists(os.path.dirname(self.journal_file)):
+                    os.makedirs(os.path.dirname(self.journal_file))
+                self.journal = open(self.journal_file, 'a')
+            self.journal.write(json.dumps(record) + "\n")
+            self.journal.flush()
+        except (IOError, OSError) as ex:
+            self.logger.error("Failed to write to the journal at '%s'. Error is %s", self.journal_file, ex)
@@ -9,13 +9,21 @@
 
 import json
 import os
+import threading
 import time
 
+from utils.AtomicFile import save_json
+
 
 class Status:
 
-    def __init__(self, logger):
+    def __init__(self, logger, sample_size=None):
         self.logger = logger
+        # with a sample size only the counters and a sample of the failed APIs are kept, so the status doesn't grow with the number of APIs
+        self.sample_size = sample_size
+        # the APIs are synced concurrently so all the status updates are guarded by this lock
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
         self.status = dict()
         self.status["time"] = 0
         self.status["has_errors"] = False
@@ -23,15 +31,30 @@ class Status:
         self.status["apis"]["added"] = dict()
         self.status["apis"]["updated"] = dict()
         self.status["apis"]["deleted"] = dict()
+        self.status["apis"]["unchanged"] = dict()
         self.status["apis"]["added"]["success"] = []
         self.status["apis"]["added"]["error"] = []
         self.status["apis"]["updated"]["success"] = []
         self.status["apis"]["updated"]["error"] = []
         self.status["apis"]["deleted"]["success"] = []
         self.status["apis"]["deleted"]["error"] = []
+        self.status["apis"]["unchanged"]["success"] = []
+        self.status["apis"]["unchanged"]["error"] = []
         self.status["fetchers"] = dict()
         self.status["fetchers"]["success"] = []
         self.status["fetchers"]["error"] = []
+        self.status["fetchers"]["regions"] = dict()
+        self.status["fetchers"]["regions"]["success"] = []
+        self.status["fetchers"]["regions"]["error"] = []
+        # the failed fetchers whose APIs were taken from their last successful fetch
+        self.status["fetchers"]["snapshot"] = []
+        self.status["deferred"] = dict()
+        self.status["deferred"]["added"] = []
+        self.status["deferred"]["updated"] = []
+        self.status["deferred"]["deleted"] = []
+        self.status["quarantined"] = []
+        self.counters = {"apis": dict((status_type, {"success": 0, "error": 0}) for status_type in self.status["apis"]),
+                         "deferred": dict((status_type, 0) for status_type in self.status["deferred"]), "quarantined": 0}
 
 
     def update_api_error(self, status_type, value):
@@ -43,41 +66,135 @@ class Status:
 
 
     def update_api_status(self, status_type, result, value):
-        self.status["apis"][status_type][result].append(value)
+        with self.lock:
+            self.counters["apis"][status_type][result] += 1
+            if self.sample_size is None or (result == "error" and len(self.status["apis"][status_type][result]) < self.sample_size):
+                self.status["apis"][status_type][result].append(value)
+
+
+    def update_api_deferred(self, status_type, value):
+        with self.lock:
+            self.counters["deferred"][status_type] += 1
+            if self.sample_size is None:
+                self.status["deferred"][status_type].append(value)
+
+
+    def update_api_quarantined(self, value, reason):
+        with self.lock:
+            self.counters["quarantined"] += 1
+            if self.sample_size is None or len(self.status["quarantined"]) < self.sample_size:
+                self.status["quarantined"].append({"api": value, "reason": reason})
 
 
     def update_fetcher_error(self, value):
-        self.status["fetchers"]["error"].append(value)
+        with self.lock:
+            self.status["fetchers"]["error"].append(value)
 
 
     def update_fetcher_success(self, value):
-        self.status["fetchers"]["success"].append(value)
+        with self.lock:
+            self.status["fetchers"]["success"].append(value)
+
+
+    def update_fetcher_snapshot(self, value):
+        with self.lock:
+            self.status["fetchers"]["snapshot"].append(value)
+
+
+    def update_fetcher_region_error(self, value):
+        with self.lock:
+            self.status["fetchers"]["regions"]["error"].append(value)
+
+
+    def update_fetcher_region_success(self, value):
+        with self.lock:
+            self.status["fetchers"]["regions"]["success"].append(value)
+
+
+    def set_metrics(self, metrics):
+        with self.lock:
+            self.status["metrics"] = metrics
 
 
     def get_status(self):
         return self.status
 
 
-    def report_status(self, path):
+    def get_deferred_count(self):
+        with self.lock:
+            return sum(self.counters["deferred"].values())
+
+
+    def get_compact_status(self, sample_size):
+        # counters instead of the lists of APIs, with only a sample of the failed APIs
+        with self.lock:
+            compact_status = {"time": self.status["time"], "has_errors": self.status["has_errors"], "apis": dict(), "fetchers": self.status["fetchers"],
+                              "deferred": dict(self.counters["deferred"])}
+            for status_type, results in self.status["apis"].items():
+                compact_status["apis"][status_type] = dict(self.counters["apis"][status_type], error_sample=results["error"][:sample_size])
+            compact_status["quarantined"] = {"total": self.counters["quarantined"], "sample": self.status["quarantined"][:sample_size]}
+            if "metrics" in self.status:
+                compact_status["metrics"] = self.status["metrics"]
+            return compact_status
+
+
+    def get_report(self, sample_size=None):
+        # the full status, or the compact status when a sample size of the failed APIs is given
+        if sample_size is None:
+            return self.status
+        return self.get_compact_status(sample_size)
+
+
+    def report_status(self, path, file_name="status.json", sample_size=None):
         if path is not None and path:
             try:
-                if not os.path.exists(path):
-                    os.makedirs(path)
-                status_file = os.path.join(path, "status.json")
+                status_file = os.path.join(path, file_name)
                 self.logger.info("Reporting status to %s", status_file)
-                with open(status_file, 'w') as outfile:
-                    json.dump(self.status, outfile)
+                save_json(status_file, self.get_report(sample_size))
             except Exception as ex:
                 self.logger.error("Failed to report status to the status file. Error is %s", ex)
 
 
+    def append_history(self, path, file_name, max_size):
+        # a line per run with its duration and counters - the history is rotated to a single backup file once it reaches the max size
+        if path is None or not path or not max_size:
+            return
+        with self.lock:
+            run_record = {
+                "time": self.status["time"],
+                "duration": round(time.monotonic() - self.start_time, 3),
+                "has_errors": self.status["has_errors"],
+                "apis": dict((status_type, dict(counts)) for status_type, counts in self.counters["apis"].items()),
+                "fetchers": {"success": len(self.status["fetchers"]["success"]), "error": len(self.status["fetchers"]["error"]), "snapshot": len(self.status["fetchers"]["snapshot"])},
+                "deferred": sum(self.counters["deferred"].values()),
+                "quarantined": self.counters["quarantined"]
+            }
+            if "metrics" in self.status:
+                run_record["phases"] = self.status["metrics"]["phases"]
+                run_record["bytes_sent"] = sum(self.status["metrics"]["counters"].get("bytes_sent_total", dict()).values())
+                run_record["saved_bytes"] = sum(self.status["metrics"]["counters"].get("saved_bytes_total", dict()).values())
+        try:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            history_file = os.path.join(path, file_name)
+            line = json.dumps(run_record) + "\n"
+            if os.path.isfile(history_file) and os.path.getsize(history_file) + len(line) > max_size:
+                os.replace(history_file, history_file + ".1")
+            with open(history_file, 'a') as outfile:
+                outfile.write(line)
+        except Exception as ex:
+            self.logger.error("Failed to append the run to the history file. Error is %s", ex)
+
+
     def calculate_status(self):
         total_errors = 0
-        for value in self.status["apis"].values():
-            if len(value["error"]) > 0:
-                total_errors += len(value["error"])
+        for counts in self.counters["apis"].values():
+            total_errors += counts["error"]
         if len(self.status["fetchers"]["error"]) > 0:
             total_errors += len(self.status["fetchers"]["error"])
+        if len(self.status["fetchers"]["regions"]["error"]) > 0:
+            total_errors += len(self.status["fetchers"]["regions"]["error"])
+        total_errors += self.counters["quarantined"]
         self.logger.info("There were %d errors while managing the APIs", total_errors)
         self.status["time"] = int(round(time.time() * 1000))
         if total_errors > 0:
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SyncExecutor:
+
+    def __init__(self, concurrency, client, status, logger, deadline=None):
+        self.client = client
+        self.status = status
+        self.logger = logger
+        self.deadline = deadline
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        # bounds the API specs which wait to be pushed, so a fast fetcher can't fill the memory with specs
+        self.pending = threading.BoundedSemaphore(concurrency * 2)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wait()
+
+
+    def submit(self, status_type, host_and_base_path, action, *args):
+        self.pending.acquire()
+        try:
+            self.executor.submit(self.run, status_type, host_and_base_path, action, *args)
+        except Exception:
+            self.pending.release()
+            raise
+
+
+    def run(self, status_type, host_and_base_path, action, *args):
+        try:
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                # the time budget of the run is over - the API is synced on the next run
+                self.status.update_api_deferred(status_type, host_and_base_path)
+                return
+            if self.client.circuit_breaker.is_open():
+                # the management URL is down so the remaining APIs are failed fast instead of waiting on it
+                self.status.update_api_error(status_type, host_and_base_path)
+                return
+            action_start = time.monotonic()
+            action(host_and_base_path, *args)
+            # the duration of the whole operation, including its retries
+            self.client.metrics.observe("sync_duration_seconds", time.monotonic() - action_start, {"action": status_type})
+        except Exception as ex:
+            # the actions handle their own request errors - this keeps an unexpected error from hiding the API result
+            self.logger.error("Unexpected error while syncing '%s' - error is '%s'", host_and_base_path, ex)
+            self.status.update_api_error(status_type, host_and_base_path)
+        finally:
+            # the API spec is released as soon as it is pushed
+            self.pending.release()
+
+
+    def wait(self):
+        self.executor.shutdown(wait=True)
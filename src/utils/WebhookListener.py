@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+##################################################
+## Author: Doron Lehmann
+## Email: Doron.Lehmann@imperva.com
+##################################################
+#
+
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from utils.ApiSpec import ApiSpec
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        self.server.listener.logger.debug("Webhook request from %s - %s", self.address_string(), format % args)
+
+
+    def do_POST(self):
+        listener = self.server.listener
+        if listener.token and not hmac.compare_digest(self.headers.get("Authorization", ""), "Bearer " + listener.token):
+            return self.send_json(401, {"error": "missing or wrong token"})
+        content_length = int(self.headers.get("Content-Length") or 0)
+        if content_length > WebhookListener.MAX_BODY_SIZE:
+            return self.send_json(413, {"error": "the body is too large"})
+        body = self.rfile.read(content_length)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/events":
+            # a source and optionally the key of the API which was changed in it - without a key all the APIs of the source are synced
+            try:
+                event = json.loads(body.decode("utf-8"))
+                source = event["source"]
+                host_and_base_path = event.get("key")
+            except (ValueError, KeyError, TypeError, AttributeError) as ex:
+                return self.send_json(400, {"error": "the event should be a JSON with a source and an optional key - %s" % ex})
+            if not listener.is_known_source(source):
+                return self.send_json(404, {"error": "unknown source '%s'" % source})
+            listener.add_event(source, host_and_base_path)
+            return self.send_json(202, {"source": source, "key": host_and_base_path})
+        if url.path == "/specs":
+            # the changed API spec itself, which is pushed without fetching it from its source
+            source = query.get("source", [None])[0]
+            if not listener.is_known_source(source):
+                return self.send_json(404, {"error": "unknown source '%s'" % source})
+            try:
+                api_spec = ApiSpec.from_json(body)
+            except (ValueError, KeyError, TypeError) as ex:
+                return self.send_json(400, {"error": "the body should be a JSON API spec with a host or a server URL - %s" % ex})
+            listener.add_api_spec(source, api_spec)
+            return self.send_json(202, {"source": source, "key": api_spec.host_and_base_path})
+        return self.send_json(404, {"error": "unknown path '%s'" % url.path})
+
+
+    def send_json(self, status_code, response_json):
+        body = json.dumps(response_json).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class WebhookListener:
+
+    MAX_BODY_SIZE = 50 * 1024 * 1024
+
+    def __init__(self, host, port, token, coalesce_delay, is_known_source, sync_events, logger):
+        self.token = token
+        self.coalesce_delay = coalesce_delay
+        self.is_known_source = is_known_source
+        self.sync_events = sync_events
+        self.logger = logger
+        self.server = WebhookServer((host, port), WebhookHandler)
+        self.server.listener = self
+        # the events are kept until the sources are quiet for the coalesce delay, so a burst of events is synced once
+        self.condition = threading.Condition()
+        self.changed_sources = dict()
+        self.api_specs = dict()
+        self.last_event_time = None
+        self.first_event_time = None
+        self.stopped = False
+
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="WebhookServer", daemon=True).start()
+        threading.Thread(target=self.run, name="WebhookSync", daemon=True).start()
+        self.logger.info("Listening to webhook events on %s:%d", self.server.server_address[0], self.server.server_address[1])
+
+
+    def stop(self):
+        self.server.shutdown()
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+
+    def add_event(self, source, host_and_base_path):
+        with self.condition:
+            self.logger.debug("Got a webhook event for '%s' from %s", host_and_base_path, source)
+            if host_and_base_path is None:
+                self.changed_sources[source] = None
+            elif source not in self.changed_sources:
+                self.changed_sources[source] = set([host_and_base_path])
+            elif self.changed_sources[source] is not None:
+                self.changed_sources[source].add(host_and_base_path)
+            self.on_event()
+
+
+    def add_api_spec(self, source, api_spec):
+        with self.condition:
+            self.logger.debug("Got a webhook API spec for '%s' from %s", api_spec.host_and_base_path, source)
+            # only the last API spec of every API is pushed
+            self.api_specs[api_spec.host_and_base_path] = (source, api_spec)
+            self.on_event()
+
+
+    def on_event(self):
+        self.last_event_time = time.monotonic()
+        if self.first_event_time is None:
+            self.first_event_time = self.last_event_time
+        self.condition.notify()
+
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    if self.first_event_time is None:
+                        self.condition.wait()
+                        continue
+                    # a constant stream of events is still synced once it waited for ten coalesce delays
+                    sync_time = min(self.last_event_time + self.coalesce_delay, self.first_event_time + self.coalesce_delay * 10)
+                    if time.monotonic() >= sync_time:
+                        break
+                    self.condition.wait(sync_time - time.monotonic())
+                if self.stopped:
+                    return
+                changed_sources, api_specs = self.changed_sources, self.api_specs
+                self.changed_sources, self.api_specs = dict(), dict()
+                self.first_event_time = None
+            try:
+                self.sync_events(changed_sources, api_specs)
+            except Exception as ex:
+                self.logger.error("Unexpected error while syncing the webhook events - error is '%s'", ex)